@@ -0,0 +1,437 @@
+'''
+Benchmarks for the engine primitives and the search.
+
+Micro benchmarks time the board helpers of main_bot, their bitboard
+equivalents and the ConnectFour referee on the positions in sample_boards/.
+Macro benchmarks measure simulations per second and tree nodes per move for
+MonteCarlo, and what sharing mirror images gains in the opening at equal
+simulations and at equal tree size.
+Every benchmark is repeated (--runs) and the median is reported, with a
+standard error combining the spread between runs and the one within a run.
+Results are written as JSON and compared with bench_baseline.json (or the
+file given with --baseline). A metric regresses when it is worse than the
+baseline by more than the threshold, or by more than twice the standard
+error of the difference if that is larger. Regressions fail the run when
+the baseline was given explicitly or recorded on the same host, against
+the default baseline from another host they are only printed.
+
+    python benchmark.py --save-baseline           # record a new baseline
+    python benchmark.py --baseline other_baseline.json
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import timeit
+
+import numpy as np
+
+import bitboard as bb
+import board_features
+import main_bot
+import opening_book
+from connectfour_offline import ConnectFour
+from fun_bots import random_bot
+from solver import Solver
+from validate_engine import load_sample_boards
+
+DEFAULT_OUTPUT = 'bench_results.json'
+DEFAULT_BASELINE = 'bench_baseline.json'
+
+
+def board_history(board):
+    # main_bot.current_player needs a previous board to break ties
+    previous = np.zeros_like(board)
+    previous[-1, 0] = 3 - bb.side_to_move(board)
+    return [previous, board]
+
+
+def mean_stderr(values):
+    '''
+    Output: (mean, standard error of the mean) of values
+    '''
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    variance = sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+    return mean, math.sqrt(variance / len(values))
+
+
+def time_per_call(function, calls, repeat=5):
+    '''
+    Output: best time (in microseconds) of one call to function
+    '''
+    number = max(1, 2000 // calls)
+    best = min(timeit.repeat(function, number=number, repeat=repeat))
+    return 1e6 * best / (number * calls)
+
+
+def micro_benchmarks(boards):
+    '''
+    Output: dict mapping benchmark names to microseconds per call,
+        averaged over all (board, legal move) pairs of the sample boards
+    '''
+    histories = [board_history(board) for board in boards]
+    positions = [bb.Position.from_array(board, bb.side_to_move(board)) for board in boards]
+    board_moves = [(history, move) for history in histories
+                   for move in main_bot.legal_moves(history[-1])]
+    position_moves = [(position, move) for position in positions
+                      for move in position.legal_moves()]
+    referee_moves = [(board, move, bb.side_to_move(board) - 1) for board in boards
+                     for move in main_bot.legal_moves(board)]
+    chain_cells = [(board, (int(np.argmax(board[:, col] != 0)), col)) for board in boards
+                   for col in range(board.shape[1]) if board[:, col].any()]
+
+    referee = ConnectFour()
+
+    def referee_move():
+        for board, move, player in referee_moves:
+            referee.board = board.copy()
+            referee.longest_chain = {'length': 0, 'player': 0}
+            referee.move(move, player)
+
+    def longest_chain():
+        for board, cell in chain_cells:
+            referee.board = board
+            referee._longest_chain(cell)
+
+    cases = {
+        'next_state': (lambda: [main_bot.next_state(h, m) for h, m in board_moves], len(board_moves)),
+        'legal_moves': (lambda: [main_bot.legal_moves(b) for b in boards], len(boards)),
+        'find_winner': (lambda: [main_bot.find_winner(b) for b in boards], len(boards)),
+        'scan_board': (lambda: [main_bot.scan_board(b) for b in boards], len(boards)),
+        'referee_move': (referee_move, len(referee_moves)),
+        'referee_longest_chain': (longest_chain, len(chain_cells)),
+        'board_features': (lambda: [board_features.compute(b) for b in boards], len(boards)),
+        'random_bot_move': (lambda: [random_bot.generate_move(b, 1, 0) for b in boards], len(boards)),
+        'bitboard_next_state': (lambda: [bb.next_state(p, m) for p, m in position_moves], len(position_moves)),
+        'bitboard_legal_moves': (lambda: [p.legal_moves() for p in positions], len(positions)),
+        'bitboard_is_winning_move': (lambda: [p.is_winning_move(m) for p, m in position_moves], len(position_moves)),
+        'bitboard_winner': (lambda: [p.winner() for p in positions], len(positions)),
+    }
+    return dict((name, time_per_call(function, calls))
+                for name, (function, calls) in cases.items())
+
+
+def search_benchmark(positions, seconds, **options):
+    '''
+    Runs MonteCarlo for `seconds` on every position.
+    Output: (simulations per second, tree nodes per move) averaged over positions
+    '''
+    rates, nodes = [], []
+    for position in positions:
+        AI = main_bot.MonteCarlo(position, **options)
+        begin = time.monotonic()
+        AI.search(seconds)
+        elapsed = time.monotonic() - begin
+        rates.append(AI.stats.simulations / elapsed)
+        nodes.append(AI.stats.tree_size[0])
+    return sum(rates) / len(rates), sum(nodes) / len(nodes)
+
+
+def solved_positions(count, seed=0, plies=(18, 28), time_limit=0.3, quiet=False):
+    '''
+    Output: list of (position, set of best moves) for random mid-game
+        positions where the solver proves the outcome of every move and the
+        moves do not all have the same outcome. With quiet, positions where
+        either side can complete a line on its next stone are skipped: an
+        immediate win or a forced block is found by any search.
+    '''
+    rng = random.Random(seed)
+    solver = Solver()
+    positions = []
+    while len(positions) < count:
+        position = bb.Position(player=1)
+        for ply in range(rng.randint(*plies)):
+            move = rng.choice(position.legal_moves())
+            if position.is_winning_move(move):
+                break
+            position.play(move)
+        else:
+            if quiet:
+                playable = (position.mask + position.BOTTOM_MASK) & position.BOARD_MASK
+                opponent = position.current ^ position.mask
+                if playable & (position.winning_cells(position.current)
+                               | position.winning_cells(opponent)):
+                    continue
+            outcomes = dict()
+            for move in position.legal_moves():
+                if position.is_winning_move(move):
+                    outcomes[move] = 1
+                    continue
+                child = bb.next_state(position, move)
+                reply, score, proven = solver.solve(child, time_limit)
+                if not proven:
+                    break
+                outcomes[move] = -(score > 0) + (score < 0)
+            else:
+                best = max(outcomes.values())
+                if min(outcomes.values()) < best:
+                    positions.append((position, set(move for move in outcomes
+                                                    if outcomes[move] == best)))
+    return positions
+
+
+def policy_accuracy(positions, seconds, **options):
+    '''
+    Output: (share, standard error) of the positions where MonteCarlo picks
+        a best move after searching for seconds
+    '''
+    hits = []
+    for position, best in positions:
+        AI = main_bot.MonteCarlo(position, time=seconds, **options)
+        move, stats = AI.get_play()
+        hits.append(float(move in best))
+    return mean_stderr(hits)
+
+
+def macro_benchmarks(boards, solved, seconds):
+    positions = [bb.Position.from_array(board, bb.side_to_move(board)) for board in boards
+                 if not main_bot.find_winner(board)]
+    results = dict()
+    for name, options in (('mcts', {}), ('mcts_batch256', {'batch': 256}),
+                          ('mcts_uniform', {'rollout_policy': 'uniform'}),
+                          ('mcts_batch256_uniform', {'batch': 256, 'rollout_policy': 'uniform'})):
+        rate, nodes = search_benchmark(positions, seconds, **options)
+        results[name + '_simulations_per_second'] = rate
+        results[name + '_nodes_per_move'] = nodes
+    # A/B of the rollout policies: how often each finds a proven best move
+    # with the same CPU time, on quiet positions and short budgets so that
+    # neither saturates, reported against the search time
+    for budget in (seconds / 50, seconds / 15, seconds / 5):
+        for policy in ('threats', 'uniform'):
+            name = 'mcts_{}_accuracy_{}ms'.format(policy, int(round(1000 * budget)))
+            results[name] = policy_accuracy(solved, budget, rollout_policy=policy)
+    return results
+
+
+SIZES = [(6, 7), (7, 8), (8, 9), (9, 10)]
+
+
+def scaling_benchmarks(seconds, plies=8, seed=0):
+    '''
+    Output: dict with the simulations per second of MonteCarlo, one at a
+        time and in batches of 256, on a position `plies` random moves into
+        a game on every board size of SIZES (connect 4)
+    '''
+    rng = random.Random(seed)
+    results = dict()
+    for rows, cols in SIZES:
+        position = bb.board_class(rows, cols, 4)(player=1)
+        while position.moves < plies:
+            move = rng.choice(position.legal_moves())
+            if not position.is_winning_move(move):
+                position.play(move)
+        for name, options in (('mcts', {}), ('mcts_batch256', {'batch': 256})):
+            rate, nodes = search_benchmark([position], seconds, **options)
+            results['{}_{}x{}_simulations_per_second'.format(name, rows, cols)] = rate
+    return results
+
+
+def opening_positions(count, seed=0, plies=(1, 5)):
+    '''
+    Output: list of (position, set of book moves) for the empty board and
+        random early positions found in the opening book, both mirrored
+        moves count for symmetric positions
+    '''
+    book = opening_book.load()
+    if book is None:
+        return []
+    rng = random.Random(seed)
+    positions = [(bb.Position(player=1), {bb.COLS // 2})]
+    for attempt in range(100 * count):
+        if len(positions) >= count:
+            break
+        position = bb.Position(player=1)
+        # nobody can win within the first plies
+        for ply in range(rng.randint(*plies)):
+            position.play(rng.choice(position.legal_moves()))
+        move = book.lookup(position)
+        if move is not None:
+            key = position.key()
+            mirrored = bb.COLS - 1 - move
+            symmetric = bb.mirror(key) == key
+            positions.append((position, {move, mirrored} if symmetric else {move}))
+    return positions
+
+
+def best_share(AI, best):
+    # share of the root visits of AI (a MonteCarlo) going to the moves in best
+    visits = dict((move, child.plays) for move, child in AI.root_children().items())
+    return sum(visits.get(move, 0) for move in best) / sum(visits.values())
+
+
+def symmetry_benchmarks(simulations=3000, nodes=1000, count=10):
+    '''
+    Output: dict comparing MonteCarlo with and without mirror symmetry on
+        opening_positions. After the same number of simulations: tree nodes,
+        tree bytes and the share of the root visits going to a book move (how
+        far the search converged). After the same number of distinct
+        positions stored (tree nodes): that share again. A shared node counts
+        as one position, the mirror image it also covers is not credited.
+    '''
+    positions = opening_positions(count)
+    results = dict()
+    if not positions:
+        return results
+    for name, symmetry in (('mcts_symmetry', True), ('mcts_nosymmetry', False)):
+        tree_nodes, tree_bytes, shares, node_shares = [], [], [], []
+        for position, best in positions:
+            AI = main_bot.MonteCarlo(position, symmetry=symmetry)
+            for i in range(simulations):
+                AI.run_simulation()
+            size = main_bot.tree_size(AI.root)
+            tree_nodes.append(size[0])
+            tree_bytes.append(size[1])
+            shares.append(best_share(AI, best))
+
+            AI = main_bot.MonteCarlo(position, symmetry=symmetry)
+            while AI.stats.nodes_created < nodes:
+                AI.run_simulation()
+            node_shares.append(best_share(AI, best))
+        results[name + '_tree_nodes'] = mean_stderr(tree_nodes)
+        results[name + '_tree_bytes'] = mean_stderr(tree_bytes)
+        results[name + '_best_share'] = mean_stderr(shares)
+        results[name + '_best_share_equal_nodes'] = mean_stderr(node_shares)
+    return results
+
+
+def median_stderr(samples):
+    '''
+    Input: samples (list of (value, standard error or None)) of one metric
+        over repeated runs
+    Output: (median of the values, standard error) where the standard error
+        adds the spread between runs to the typical one within a run
+    '''
+    values = [value for value, stderr in samples]
+    within = [stderr for value, stderr in samples if stderr is not None]
+    spread = mean_stderr(values)[1]
+    if within:
+        spread = math.sqrt(spread ** 2 + statistics.median(within) ** 2)
+    return statistics.median(values), spread
+
+
+def run(seconds=0.5, runs=3):
+    '''
+    Output: dict mapping metric names to {'value', 'unit', 'better',
+        'stderr'}, the median over runs repetitions of every benchmark
+    '''
+    boards = load_sample_boards()
+    solved = solved_positions(40, quiet=True)
+    samples = dict()
+    for i in range(runs):
+        micro = micro_benchmarks(boards)
+        results = dict(micro)
+        results.update(macro_benchmarks(boards, solved, seconds))
+        results.update(scaling_benchmarks(seconds))
+        results.update(symmetry_benchmarks())
+        for name, value in results.items():
+            if not isinstance(value, tuple):
+                value = (value, None)
+            samples.setdefault(name, []).append(value)
+    metrics = dict()
+    for name, values in samples.items():
+        value, stderr = median_stderr(values)
+        better = 'higher'
+        if name in micro:
+            unit, better = 'us/call', 'lower'
+        elif name.endswith('per_second'):
+            unit = 'simulations/s'
+        elif '_accuracy_' in name:
+            unit = 'best moves'
+        elif 'best_share' in name:
+            unit = 'root visits'
+        elif name.endswith('bytes'):
+            unit, better = 'bytes', 'lower'
+        elif name.endswith('tree_nodes'):
+            unit, better = 'nodes', 'lower'
+        else:
+            unit = 'nodes'
+        metrics[name] = {'value': value, 'unit': unit, 'better': better, 'stderr': stderr}
+    return metrics
+
+
+def compare(metrics, baseline, threshold):
+    '''
+    Output: list of (name, baseline value, new value, relative change) for
+        every metric that got worse than its baseline by more than threshold
+        (relative), or by more than two standard errors of the difference
+        when both have a standard error and that is the larger margin
+    '''
+    regressions = []
+    for name, metric in sorted(metrics.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], metric['value']
+        change = (new - old) / old if old else 0.0
+        tolerance = threshold * abs(old)
+        if 'stderr' in metric and 'stderr' in baseline[name]:
+            noise = 2 * math.sqrt(metric['stderr'] ** 2 + baseline[name]['stderr'] ** 2)
+            tolerance = max(tolerance, noise)
+        loss = new - old if metric['better'] == 'lower' else old - new
+        if loss > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Connect-4 engine.')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=None,
+                        help='baseline JSON to compare against (default: {} if it '
+                             'exists)'.format(DEFAULT_BASELINE))
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative regression before failing')
+    parser.add_argument('--seconds', type=float, default=0.5,
+                        help='search time per position for the macro benchmarks')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='repetitions of every benchmark, the median is reported')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='also write the results to ' + DEFAULT_BASELINE)
+    args = parser.parse_args()
+
+    metrics = run(args.seconds, args.runs)
+    report = {
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'metrics': metrics,
+    }
+    for name, metric in sorted(metrics.items()):
+        print('{:<40} {:>14.2f} {}'.format(name, metric['value'], metric['unit']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    strict = args.baseline is not None
+    if args.baseline is None and not args.save_baseline and os.path.exists(DEFAULT_BASELINE):
+        args.baseline = DEFAULT_BASELINE
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # timings recorded on another machine are only indicative
+        strict = strict or baseline.get('host') == report['host']
+        regressions = compare(metrics, baseline['metrics'], args.threshold)
+        for name, old, new, change in regressions:
+            print('{} {}: {:.2f} -> {:.2f} ({:+.0%})'.format(
+                'REGRESSION' if strict else 'warning: slower than baseline',
+                name, old, new, change))
+        if regressions and not strict:
+            print('{} was recorded on {}, not failing (pass --baseline to '
+                  'enforce it)'.format(args.baseline, baseline.get('host', 'another host')))
+        if regressions and strict:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
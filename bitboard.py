@@ -0,0 +1,455 @@
+# Bitboard position representation for the Connect-4 engine.
+#
+# Layout follows the classic scheme used by most Connect-4 solvers: every
+# column takes ROWS + 1 bits (the extra bit is a sentinel that keeps the
+# columns separated), bit 0 of a column is the bottom cell.
+#
+#     6 13 20 27 34 41 48
+#     5 12 19 26 33 40 47
+#     4 11 18 25 32 39 46
+#     3 10 17 24 31 38 45
+#     2  9 16 23 30 37 44
+#     1  8 15 22 29 36 43
+#     0  7 14 21 28 35 42
+#
+# A position is stored as two masks: `current` holds the stones of the player
+# to move, `mask` holds all stones. Applying a move, generating legal moves
+# and finding the side to move are all O(1) integer operations.
+#
+# The module constants describe the standard 6x7 board with four to connect.
+# board_class() builds Position classes for other board sizes and connect
+# lengths with the same layout.
+
+import numpy as np
+
+ROWS = 6
+COLS = 7
+CONNECT = 4
+H1 = ROWS + 1
+
+BOTTOM_MASK = sum(1 << (col * H1) for col in range(COLS))
+BOARD_MASK = BOTTOM_MASK * ((1 << ROWS) - 1)
+
+
+def bottom_mask_col(col, rows=ROWS):
+    return 1 << (col * (rows + 1))
+
+
+def top_mask_col(col, rows=ROWS):
+    return 1 << (rows - 1 + col * (rows + 1))
+
+
+def column_mask(col, rows=ROWS):
+    return ((1 << rows) - 1) << (col * (rows + 1))
+
+
+BOTTOM = [bottom_mask_col(col) for col in range(COLS)]
+TOP = [top_mask_col(col) for col in range(COLS)]
+COLUMN = [column_mask(col) for col in range(COLS)]
+
+
+def line_masks(length=CONNECT, rows=ROWS, cols=COLS):
+    '''
+    Output: list of bitmasks, one for every straight line of length cells
+    (horizontal, vertical and both diagonals) that fits on the board.
+    '''
+    h1 = rows + 1
+    lines = []
+    for col in range(cols):
+        for row in range(rows):
+            for dcol, drow in ((1, 0), (0, 1), (1, 1), (1, -1)):
+                cells = [(col + i * dcol, row + i * drow) for i in range(length)]
+                if all(0 <= c < cols and 0 <= r < rows for c, r in cells):
+                    lines.append(sum(1 << (c * h1 + r) for c, r in cells))
+    return lines
+
+
+def cell_windows(windows, rows=ROWS, cols=COLS):
+    '''
+    Output: dict mapping the bit of every cell to the windows passing through it
+    '''
+    bits = [1 << (col * (rows + 1) + row) for col in range(cols) for row in range(rows)]
+    return dict((bit, [w for w in windows if w & bit]) for bit in bits)
+
+
+WINDOWS = line_masks()
+# Maps the bit of every cell to the four-in-a-row windows passing through it.
+CELL_WINDOWS = cell_windows(WINDOWS)
+
+
+def connects_four(stones, bit, cell_windows=CELL_WINDOWS):
+    '''
+    Input: stones (int) bitmask of one player, bit (int) the cell just played,
+        cell_windows (dict) of the board, see Position.CELL_WINDOWS
+    Method: only tests the windows through bit, like
+        ConnectFour._longest_chain does for the referee.
+    Output: True if bit is part of a winning line
+    '''
+    for window in cell_windows[bit]:
+        if stones & window == window:
+            return True
+    return False
+
+
+def alignment(stones, rows=ROWS, connect=CONNECT):
+    '''
+    Input: stones (int) bitmask of a single player's stones
+    Output: True if the stones contain `connect` in a row
+    '''
+    # horizontal, both diagonals and vertical
+    for shift in (rows + 1, rows, rows + 2, 1):
+        # m marks the start of every run of `length` stones, doubling the
+        # length each step and closing the gap to `connect` at the end
+        m, length = stones, 1
+        while 2 * length <= connect:
+            m &= m >> (length * shift)
+            length *= 2
+        if length < connect:
+            m &= m >> ((connect - length) * shift)
+        if m:
+            return True
+    return False
+
+
+def winning_cells(stones, mask, rows=ROWS, connect=CONNECT, board_mask=BOARD_MASK):
+    '''
+    Input: stones (int) bitmask of one player, mask (int) all stones
+    Output: bitmask of the empty cells that would give stones `connect` in a row
+    '''
+    # vertical: only the cell above connect - 1 stones
+    cells = stones << 1
+    for i in range(2, connect):
+        cells &= stones << i
+    # horizontal and both diagonals: the gap can be at any cell of the line
+    for shift in (rows + 1, rows, rows + 2):
+        for gap in range(connect):
+            line = board_mask
+            for i in range(connect):
+                if i < gap:
+                    line &= stones << (gap - i) * shift
+                elif i > gap:
+                    line &= stones >> (i - gap) * shift
+            cells |= line
+    return cells & (board_mask ^ mask)
+
+
+def mirror_table(cols=COLS, h1=H1):
+    '''
+    Output: (centre, pairs) for mirror(): the mask of the middle column (0
+        for an even number of columns) and, for every column of the left
+        half, its mask and the shift that moves it onto its mirror column
+    '''
+    column = (1 << h1) - 1
+    centre = column << (cols // 2 * h1) if cols % 2 else 0
+    pairs = tuple((column << (col * h1), (cols - 1 - 2 * col) * h1)
+                  for col in range(cols // 2))
+    return centre, pairs
+
+
+MIRROR = mirror_table()
+_mirror_tables = {(COLS, H1): MIRROR}
+
+
+def mirror(bits, cols=COLS, h1=H1, table=None):
+    '''
+    Input: bits (int) any bitboard or key of the board, table (tuple) the
+        mirror_table(cols, h1) if the caller has it at hand
+    Output: bits with the columns in reverse order (left-right mirror)
+    '''
+    if table is None:
+        if (cols, h1) not in _mirror_tables:
+            _mirror_tables[cols, h1] = mirror_table(cols, h1)
+        table = _mirror_tables[cols, h1]
+    centre, pairs = table
+    mirrored = bits & centre
+    # swap every column of the left half with its mirror column
+    for mask, shift in pairs:
+        mirrored |= (bits & mask) << shift | (bits >> shift) & mask
+    return mirrored
+
+
+class Position(object):
+    '''
+    Connect-4 position as a pair of bitboards.
+
+    current: stones of the player to move
+    mask:    all stones on the board
+    moves:   number of stones played
+    player:  number (1 or 2) of the player to move
+
+    The board geometry lives in class attributes. Position is the standard
+    6x7 connect-4 board, board_class() makes subclasses for other sizes.
+    Python integers have no fixed width, so boards of more than 64 bits
+    use the same code.
+    '''
+    __slots__ = ('current', 'mask', 'moves', 'player')
+    ROWS = ROWS
+    COLS = COLS
+    CONNECT = CONNECT
+    H1 = H1
+    CELLS = ROWS * COLS
+    BOTTOM = BOTTOM
+    TOP = TOP
+    COLUMN = COLUMN
+    BOTTOM_MASK = BOTTOM_MASK
+    BOARD_MASK = BOARD_MASK
+    CELL_WINDOWS = CELL_WINDOWS
+    MIRROR = MIRROR
+    # center columns take part in the most windows, search them first
+    ORDER = sorted(range(COLS), key=lambda col: abs(COLS // 2 - col))
+
+    def __init__(self, current=0, mask=0, moves=0, player=1):
+        self.current = current
+        self.mask = mask
+        self.moves = moves
+        self.player = player
+
+    @classmethod
+    def from_array(cls, board, player):
+        '''
+        Input: board (np.array) as used by the referee, player (int) to move
+        Output: Position equivalent to board
+        '''
+        rows, h1 = cls.ROWS, cls.H1
+        current, mask, moves = 0, 0, 0
+        for row in range(rows):
+            for col in range(cls.COLS):
+                digit = board[rows - 1 - row, col]
+                if digit:
+                    bit = 1 << (col * h1 + row)
+                    mask |= bit
+                    moves += 1
+                    if digit == player:
+                        current |= bit
+        return cls(current, mask, moves, player)
+
+    def to_array(self):
+        '''
+        Output: board (np.array) of floats in the referee's format
+        '''
+        rows, h1 = self.ROWS, self.H1
+        board = np.zeros((rows, self.COLS))
+        other = 3 - self.player
+        opponent = self.current ^ self.mask
+        for row in range(rows):
+            for col in range(self.COLS):
+                bit = 1 << (col * h1 + row)
+                if self.current & bit:
+                    board[rows - 1 - row, col] = self.player
+                elif opponent & bit:
+                    board[rows - 1 - row, col] = other
+        return board
+
+    def copy(self):
+        return self.__class__(self.current, self.mask, self.moves, self.player)
+
+    def key(self):
+        # Unique for the stones on the board and the side to move
+        # (the sentinel row makes current + mask unambiguous).
+        return self.current + self.mask
+
+    def canonical(self):
+        '''
+        Output: (key, mirrored) where key is the smaller of key() and the key
+            of the mirror image, the same for both orientations, and mirrored
+            is True if key belongs to the mirror image. Moves then map
+            between the two frames as col <-> COLS - 1 - col.
+        '''
+        key = self.current + self.mask
+        other = mirror(key, table=self.MIRROR)
+        if other < key:
+            return other, True
+        return key, False
+
+    def canonical_moves(self):
+        '''
+        Output: the legal moves in the frame of canonical(), of a symmetric
+            position only the left half and the centre
+        '''
+        key = self.current + self.mask
+        other = mirror(key, table=self.MIRROR)
+        last = self.COLS - 1
+        legal = self.legal_moves()
+        if other < key:
+            return [last - col for col in reversed(legal)]
+        if other == key:
+            return [col for col in legal if 2 * col <= last]
+        return legal
+
+    def can_play(self, col):
+        return not self.mask & self.TOP[col]
+
+    def legal_moves(self):
+        mask = self.mask
+        return [col for col, top in enumerate(self.TOP) if not mask & top]
+
+    def play(self, col):
+        '''
+        Input: col (int) column to drop a stone in
+        Assumes: can_play(col)
+        Method: switch perspective and add the lowest free bit of col to mask
+        '''
+        bit = (self.mask + self.BOTTOM[col]) & self.COLUMN[col]
+        self.current ^= self.mask
+        self.mask |= bit
+        self.moves += 1
+        self.player = 3 - self.player
+
+    def is_winning_move(self, col):
+        '''
+        Output: True if the player to move connects four by playing col
+        '''
+        bit = (self.mask + self.BOTTOM[col]) & self.COLUMN[col]
+        return connects_four(self.current | bit, bit, self.CELL_WINDOWS)
+
+    def winner(self):
+        '''
+        Output:
+            0 if no winner,
+            1 if player 1 wins,
+            2 if player 2 wins,
+            -1 if tie. (full board)
+        Assumes: only the player who moved last can have four in a row,
+            which holds for every position reached through play().
+        Method: scans the whole board, search code should prefer
+            is_winning_move() before playing and the move counter for draws.
+        '''
+        if alignment(self.current ^ self.mask, self.ROWS, self.CONNECT):
+            return 3 - self.player
+        if self.moves == self.CELLS:
+            return -1
+        return 0
+
+    def winning_cells(self, stones):
+        '''
+        Output: the empty cells that would complete a line for stones
+        '''
+        return winning_cells(stones, self.mask, self.ROWS, self.CONNECT, self.BOARD_MASK)
+
+
+_board_classes = {(ROWS, COLS, CONNECT): Position}
+
+
+def board_class(rows=ROWS, cols=COLS, connect=CONNECT):
+    '''
+    Input: rows, cols (int) size of the board, connect (int) stones in a row
+        needed to win
+    Output: Position subclass for that board, created once per process
+    '''
+    geometry = (rows, cols, connect)
+    if geometry not in _board_classes:
+        h1 = rows + 1
+        bottom_mask = sum(bottom_mask_col(col, rows) for col in range(cols))
+        board_mask = bottom_mask * ((1 << rows) - 1)
+        attributes = {
+            '__slots__': (),
+            'ROWS': rows, 'COLS': cols, 'CONNECT': connect, 'H1': h1,
+            'CELLS': rows * cols,
+            'BOTTOM': [bottom_mask_col(col, rows) for col in range(cols)],
+            'TOP': [top_mask_col(col, rows) for col in range(cols)],
+            'COLUMN': [column_mask(col, rows) for col in range(cols)],
+            'BOTTOM_MASK': bottom_mask,
+            'BOARD_MASK': board_mask,
+            'CELL_WINDOWS': cell_windows(line_masks(connect, rows, cols), rows, cols),
+            'MIRROR': mirror_table(cols, h1),
+            'ORDER': sorted(range(cols), key=lambda col: abs(cols // 2 - col)),
+        }
+        name = 'Position{}x{}c{}'.format(rows, cols, connect)
+        _board_classes[geometry] = type(name, (Position,), attributes)
+    return _board_classes[geometry]
+
+
+def from_board(board, player, connect=CONNECT):
+    '''
+    Input: board (np.array) of any size, player (int) to move,
+        connect (int) stones in a row needed to win
+    Output: Position of the matching board_class
+    '''
+    rows, cols = board.shape
+    return board_class(rows, cols, connect).from_array(board, player)
+
+
+def position_winning_cells(position, stones):
+    '''
+    Output: winning_cells of stones on the board of position
+    '''
+    return winning_cells(stones, position.mask, position.ROWS, position.CONNECT,
+                         position.BOARD_MASK)
+
+
+class ThreatTable(object):
+    '''
+    Empty cells that would complete a line, per player. Built once from a
+    position with winning_cells, then kept up to date move by move through
+    the windows of the cell played (Position.CELL_WINDOWS).
+
+    threats: [None, threats of player 1, threats of player 2] as bitmasks
+    '''
+    __slots__ = ('threats',)
+
+    def __init__(self, position):
+        other = position.current ^ position.mask
+        self.threats = [None, 0, 0]
+        self.threats[position.player] = position.winning_cells(position.current)
+        self.threats[3 - position.player] = position.winning_cells(other)
+
+    def play(self, position, col):
+        '''
+        Input: position (Position) before col is played
+        Method: a stone can only create threats in the windows through it,
+            and only removes the cell it fills from the threats of either side
+        Output: True if col wins the game for the player to move
+        '''
+        bit = (position.mask + position.BOTTOM[col]) & position.COLUMN[col]
+        threats = self.threats
+        player = position.player
+        if threats[player] & bit:
+            return True
+        threats[1] &= ~bit
+        threats[2] &= ~bit
+        stones = position.current | bit
+        mask = position.mask | bit
+        for window in position.CELL_WINDOWS[bit]:
+            rest = window & ~stones
+            # exactly one cell of the window left, and it is empty
+            if not rest & (rest - 1) and not rest & mask:
+                threats[player] |= rest
+        return False
+
+
+def next_state(position, move):
+    '''
+    Bitboard equivalent of main_bot.next_state.
+    Output: new Position with move applied, position is left untouched
+    '''
+    child = position.copy()
+    child.play(move)
+    return child
+
+
+def legal_moves(position):
+    '''Bitboard equivalent of main_bot.legal_moves.'''
+    return position.legal_moves()
+
+
+def find_winner(position):
+    '''Bitboard equivalent of main_bot.find_winner.'''
+    if alignment(position.current, position.ROWS, position.CONNECT):
+        return position.player
+    return position.winner()
+
+
+def current_player(position):
+    '''Bitboard equivalent of main_bot.current_player.'''
+    return position.player
+
+
+def side_to_move(board):
+    '''
+    Input: board (np.array) as used by the referee
+    Output: player (int) to move, the one with fewer stones. With equal
+        counts the board alone cannot tell who started; player 1 is assumed.
+    '''
+    ones = np.count_nonzero(board == 1)
+    twos = np.count_nonzero(board == 2)
+    return 2 if ones > twos else 1
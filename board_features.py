@@ -0,0 +1,146 @@
+'''
+Per-column features of a referee board, shared by the bots and the referee.
+
+features(board) returns the column heights, the free space per column, the
+open (playable) columns and the owner and length of the chain on top of
+every column. They are computed once per position with a handful of NumPy
+operations, or from the features of the previous position when the referee
+passes them along, and kept in a small LRU cache keyed by the board
+contents, so every bot asking about the same position gets them for free.
+The arrays are read-only since they are shared.
+'''
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_SIZE = 4096
+
+
+class BoardFeatures(object):
+    '''
+    heights:      number of stones per column
+    space:        number of empty cells per column
+    open_columns: the columns that are not full, in increasing order
+    top_player:   player (1 or 2) owning the top stone of every column, 0 if empty
+    top_length:   length of the run of top_player stones from the top down
+    '''
+    __slots__ = ('rows', 'cols', 'heights', 'space', 'open_columns',
+                 'top_player', 'top_length')
+
+    def __init__(self, rows, cols, heights, space, top_player, top_length):
+        self.rows = rows
+        self.cols = cols
+        self.heights = _frozen(heights)
+        self.space = _frozen(space)
+        self.open_columns = _frozen(np.flatnonzero(space))
+        self.top_player = _frozen(top_player)
+        self.top_length = _frozen(top_length)
+
+    def chains(self):
+        '''
+        Output: list of (column, player, length) of the top chain per column,
+            player and length None for an empty column
+        '''
+        return [(col, int(player), int(length)) if player else (col, None, None)
+                for col, (player, length) in enumerate(zip(self.top_player, self.top_length))]
+
+    def eligible_columns(self, player, connect=4):
+        '''
+        Output: tuple of the columns whose top chain belongs to player and
+            still has room to grow to connect stones
+        '''
+        eligible = (self.top_player == player) & (connect - self.top_length <= self.space)
+        return tuple(np.flatnonzero(eligible).tolist())
+
+
+def _frozen(array):
+    array.flags.writeable = False
+    return array
+
+
+def compute(board):
+    '''
+    Input: board (np.array) in the referee's format
+    Output: BoardFeatures of board, computed from scratch
+    '''
+    rows, cols = board.shape
+    columns = np.arange(cols)
+    heights = np.count_nonzero(board, axis=0)
+    space = rows - heights
+    # row of the top stone of every column (rows for an empty column)
+    top_row = space
+    top_player = np.where(heights > 0, board[np.minimum(top_row, rows - 1), columns], 0)
+    top_player = top_player.astype(np.int64)
+    # walk down from the top stone while the stones are the same
+    walk = top_row[None, :] + np.arange(rows)[:, None]
+    cells = board[np.minimum(walk, rows - 1), columns[None, :]]
+    same = (walk < rows) & (cells == top_player) & (top_player != 0)
+    top_length = np.cumprod(same, axis=0).sum(axis=0)
+    return BoardFeatures(rows, cols, heights, space, top_player, top_length)
+
+
+def after_move(parent, col, player):
+    '''
+    Input: parent (BoardFeatures), col (int) column a stone was dropped in,
+        player (int) 1 or 2 who dropped it
+    Output: BoardFeatures of the resulting board, derived from parent
+    '''
+    heights = parent.heights.copy()
+    space = parent.space.copy()
+    top_player = parent.top_player.copy()
+    top_length = parent.top_length.copy()
+    heights[col] += 1
+    space[col] -= 1
+    if top_player[col] == player:
+        top_length[col] += 1
+    else:
+        top_player[col], top_length[col] = player, 1
+    return BoardFeatures(parent.rows, parent.cols, heights, space, top_player, top_length)
+
+
+_cache = OrderedDict()
+_counters = {'hits': 0, 'misses': 0}
+
+
+def features(board, parent=None, move=None):
+    '''
+    Input: board (np.array) in the referee's format, optionally the
+        features of the previous position (parent) and the move (column,
+        player) that led to board
+    Output: BoardFeatures of board, from the cache if it was seen recently
+    '''
+    board = np.asarray(board)
+    key = (board.shape, board.dtype.str, board.tobytes())
+    cached = _cache.get(key)
+    if cached is not None:
+        _cache.move_to_end(key)
+        _counters['hits'] += 1
+        return cached
+    _counters['misses'] += 1
+    if parent is not None:
+        cached = after_move(parent, *move)
+    else:
+        cached = compute(board)
+    _cache[key] = cached
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return cached
+
+
+def legal_moves(board):
+    '''
+    Output: np.array of the columns of board that are not full
+    '''
+    return features(board).open_columns
+
+
+def cache_info():
+    '''
+    Output: dict with the hits, misses and size of the cache
+    '''
+    return dict(_counters, size=len(_cache))
+
+
+def cache_clear():
+    _cache.clear()
+    _counters['hits'] = _counters['misses'] = 0
@@ -0,0 +1,228 @@
+"""Bots in worker subprocesses with a hard deadline per move, and the move
+latency statistics of a match.
+
+A SandboxedBot wraps a generate_move function. The function runs in a
+persistent child process, which keeps the saved states of its games, so
+the harness only ever sees an opaque token. When no move arrives within the
+deadline the child is killed and restarted, and the move is either taken
+from the fallback or forfeited by raising Forfeit. A bot that raises, or
+that blocks on input like query_bot, is handled the same way.
+
+    challenger = SandboxedBot(main_bot.generate_move, deadline=1.0)
+    play_connect_four(challenger, opponent, deadline=1.0, latency_path='latency.json')
+"""
+import collections
+import itertools
+import json
+import multiprocessing
+import sys
+
+import numpy as np
+
+from game_log import search_report
+
+# Bins of the exported histograms: 8 per decade from 100 us to 100 s
+HISTOGRAM_EDGES = np.logspace(-4, 2, 49)
+
+
+class Forfeit(Exception):
+    pass
+
+
+def bot_name(mover):
+    """Return the name a generate_move function is reported under."""
+    name = getattr(mover, 'name', None)
+    if name is None:
+        name = '{}:{}'.format(mover.__module__, mover.__qualname__)
+    return name
+
+
+def end_game(mover, saved_state):
+    """Tell a bot that the game of saved_state is over.
+
+    The bot is told through an end_game(saved_state) function found on the
+    mover, on the object of a bound method mover, or in the module of the
+    mover. Bots without one are left alone.
+    """
+    if saved_state is None:
+        return
+    hook = getattr(mover, 'end_game', None)
+    if hook is None:
+        hook = getattr(getattr(mover, '__self__', None), 'end_game', None)
+    if hook is None:
+        hook = getattr(sys.modules.get(mover.__module__), 'end_game', None)
+    if hook is not None:
+        hook(saved_state)
+
+
+def bot_worker(conn, mover, keep=8):
+    """Serve moves of one bot until None is received. ('end', token)
+    ends the game of token, it is not answered.
+
+    Args:
+        conn (multiprocessing.Connection): pipe to the harness.
+        mover (function): the generate_move function of the bot.
+        keep (int): number of games whose saved state is kept.
+    """
+    states = collections.OrderedDict()
+    conn.send(('ready', None))
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        if isinstance(message[0], str):
+            state = states.pop(message[1], None)
+            try:
+                end_game(mover, state)
+            except Exception:
+                pass
+            continue
+        board, player, token, options = message
+        try:
+            result = mover(board, player, states.pop(token, None), **options)
+        except Exception as e:
+            conn.send(('error', '{}: {}'.format(type(e).__name__, e), None))
+            continue
+        report = None
+        if isinstance(result, tuple):
+            action, states[token] = result
+            report = search_report(states[token])
+            while len(states) > keep:
+                states.popitem(last=False)
+        else:
+            action = result
+        conn.send(('ok', action, report))
+
+
+class SandboxedBot(object):
+    """A generate_move function running in its own subprocess.
+
+    Args:
+        mover (function): the generate_move function to run.
+        deadline (float): seconds allowed per move.
+        fallback (int or function): the column played when the bot misses
+            the deadline or fails, or a function (board, player) -> column.
+            None forfeits the game instead.
+        recorder (LatencyRecorder): where timeouts and errors are counted.
+
+    The search statistics of the last move (see game_log.search_report) are
+    kept in last_report, since the saved state never leaves the worker.
+    """
+
+    def __init__(self, mover, deadline=1.0, fallback=None, recorder=None):
+        self.mover = mover
+        self.name = bot_name(mover)
+        self.deadline = deadline
+        self.fallback = fallback
+        self.recorder = recorder
+        self.tokens = itertools.count()
+        self.last_report = None
+        self.process = None
+        self.conn = None
+        self.start()
+
+    def start(self):
+        """Start the worker and wait until the bot is imported, so start-up
+        time is not charged to the first move."""
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=bot_worker, args=(child, self.mover))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.conn.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.process = None
+
+    def __call__(self, board, player, saved_state=None, **options):
+        """Same interface as generate_move, saved_state is a game token."""
+        token = saved_state if saved_state is not None else next(self.tokens)
+        if self.process is None:
+            self.start()
+        self.conn.send((board, player, token, options))
+        if self.conn.poll(self.deadline):
+            status, value, self.last_report = self.conn.recv()
+        else:
+            # the worker may be stuck anywhere, only killing it is safe
+            self.kill()
+            status, value = 'timeout', 'no move within {:.3f} seconds'.format(self.deadline)
+            self.last_report = None
+        if status == 'ok':
+            return value, token
+        if status == 'error':
+            # the bot may have left broken module state behind, the next
+            # move starts a fresh worker
+            self.kill()
+        if self.recorder is not None:
+            self.recorder.note(self.name, status)
+        if self.fallback is None:
+            raise Forfeit('{} forfeits: {}'.format(self.name, value))
+        if callable(self.fallback):
+            return self.fallback(board, player), token
+        return self.fallback, token
+
+    def end_game(self, token):
+        """Pass the end of the game of token on to the bot, if the worker
+        still has its state."""
+        if self.process is not None:
+            self.conn.send(('end', token))
+
+    def close(self):
+        if self.process is not None:
+            self.conn.send(None)
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.kill()
+            self.conn.close()
+            self.process = None
+
+
+class LatencyRecorder(object):
+    """Move times and incidents (timeouts, errors) per bot."""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.events = collections.defaultdict(collections.Counter)
+
+    def record(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def note(self, name, event):
+        self.events[name][event] += 1
+
+    def summary(self):
+        """Return a dict with, per bot, the number of moves, the mean,
+        p50/p95/p99/max latency in seconds, the incident counts and the
+        histogram as [upper bin edge, count] pairs of the non-empty bins."""
+        summary = dict()
+        for name in sorted(set(self.latencies) | set(self.events)):
+            times = np.array(self.latencies[name], dtype=np.float64)
+            stats = {'moves': len(times)}
+            if len(times):
+                p50, p95, p99 = np.percentile(times, [50, 95, 99])
+                counts, edges = np.histogram(np.clip(times, HISTOGRAM_EDGES[0], HISTOGRAM_EDGES[-1]),
+                                             HISTOGRAM_EDGES)
+                stats.update(mean=float(times.mean()), p50=float(p50), p95=float(p95),
+                             p99=float(p99), max=float(times.max()),
+                             histogram=[[float(edge), int(count)]
+                                        for edge, count in zip(edges[1:], counts) if count])
+            stats.update(self.events[name])
+            summary[name] = stats
+        return summary
+
+    def export(self, path):
+        """Write the summary to path as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def print_summary(self):
+        print('{:<40} {:>6} {:>9} {:>9} {:>9} {:>9} {:>8} {:>6}'.format(
+            'bot', 'moves', 'p50', 'p95', 'p99', 'max', 'timeout', 'error'))
+        for name, stats in self.summary().items():
+            print('{:<40} {:>6} {:>9.4f} {:>9.4f} {:>9.4f} {:>9.4f} {:>8} {:>6}'.format(
+                name, stats['moves'], stats.get('p50', 0.0), stats.get('p95', 0.0),
+                stats.get('p99', 0.0), stats.get('max', 0.0), stats.get('timeout', 0),
+                stats.get('error', 0)))
@@ -1,6 +1,10 @@
 import numpy as np
 import time
 
+import board_features
+from bot_sandbox import Forfeit, LatencyRecorder, SandboxedBot, bot_name, end_game
+from game_log import GameLog, search_report
+
 class ConnectFourException(Exception):
     pass
 
@@ -8,10 +12,18 @@ class ConnectFourException(Exception):
 class ConnectFour(object):
     ROWS = 6
     COLS = 7
+    CONNECT = 4
+
 
+    def __init__(self, rows=ROWS, cols=COLS, connect=CONNECT):
+        """Initialize an empty grid.
 
-    def __init__(self):
-        """Initialize an empty grid."""
+        Args:
+            rows (int): The height of the grid.
+            cols (int): The width of the grid.
+            connect (int): The chain length that wins the game.
+        """
+        self.ROWS, self.COLS, self.CONNECT = rows, cols, connect
         self.board = np.zeros((self.ROWS, self.COLS))
         self.players = [1.0, 2.0]
         self.longest_chain = {'length': 0, 'player': 0}
@@ -41,13 +53,16 @@ class ConnectFour(object):
 
         # If a player tries to add a token to a full column,
         # the token is discarded
-        [spaces] = np.where(row == 0)
-        if len(spaces) == 0:
+        features = board_features.features(self.board)
+        if features.space[action] == 0:
             raise ConnectFourException(
                 'Impossible to add a token to a full column.')
 
-        pos = np.max(spaces)
+        # Tokens fall to the lowest empty cell
+        pos = features.space[action] - 1
         row[pos] = digit
+        # The bots find the features of the new board in the cache
+        board_features.features(self.board, features, (action, int(digit)))
 
         # Update the chain length
         chain_length = self._longest_chain((pos, action))
@@ -61,25 +76,25 @@ class ConnectFour(object):
 
         The game is done when:
             - their are no empty spaces left
-            - a player connects 4 tokens
+            - a player connects CONNECT tokens
 
         Returns:
             info (dict): State information.
         """
         done = False
 
-        if len(self.board[self.board == 0]) == 0:
+        if not board_features.features(self.board).space.any():
             done = True
 
-        if self.longest_chain['length'] >= 4:
+        if self.longest_chain['length'] >= self.CONNECT:
             done = True
 
         points = [0, 0]
         for i, player in enumerate(self.players):
             if int(player) == int(self.longest_chain['player']) + 1:
-                points[i] = 5 if self.longest_chain['length'] >= 4 else 1
+                points[i] = 5 if self.longest_chain['length'] >= self.CONNECT else 1
             else:
-                points[i] = -5 if self.longest_chain['length'] >= 4 else -1
+                points[i] = -5 if self.longest_chain['length'] >= self.CONNECT else -1
 
         info = {
             'done': done,
@@ -164,6 +179,130 @@ class ConnectFour(object):
         return res
 
 
+class BatchConnectFour(object):
+    """N independent ConnectFour games stored in contiguous arrays.
+
+    Every game follows the rules and scoring of ConnectFour: the longest
+    chain made by a single move decides the points, and a game is done when
+    the board is full or a chain of CONNECT is made.
+    """
+    ROWS = ConnectFour.ROWS
+    COLS = ConnectFour.COLS
+    CONNECT = ConnectFour.CONNECT
+    # (dy, dx) moves walked from a new token, grouped per direction as in
+    # ConnectFour._longest_chain
+    DIRECTIONS = [
+        [(1, 0)],            # Vertical
+        [(0, -1), (0, 1)],   # Horizontal
+        [(-1, -1), (1, 1)],  # First diagonal
+        [(1, -1), (-1, 1)]   # Second diagonal
+    ]
+
+    def __init__(self, nb_games, rows=ROWS, cols=COLS, connect=CONNECT):
+        """Initialize nb_games empty grids, see ConnectFour for the sizes."""
+        self.ROWS, self.COLS, self.CONNECT = rows, cols, connect
+        self.nb_games = nb_games
+        self.boards = np.zeros((nb_games, self.ROWS, self.COLS))
+        self.heights = np.zeros((nb_games, self.COLS), dtype=np.int64)
+        self.chain_length = np.zeros(nb_games, dtype=np.int64)
+        self.chain_player = np.zeros(nb_games, dtype=np.int64)
+        self.illegal = np.zeros(nb_games, dtype=bool)
+
+    def reset(self, games=None):
+        """Empty the grids of the given games (all games by default)."""
+        games = slice(None) if games is None else games
+        self.boards[games] = 0
+        self.heights[games] = 0
+        self.chain_length[games] = 0
+        self.chain_player[games] = 0
+        self.illegal[games] = False
+
+    def move(self, actions, players):
+        """Add one token to every game that is not done yet.
+
+        Args:
+            actions (np.array): The column to play in, one per game.
+            players (np.array or int): The player index (0 or 1) making the
+                                       move, one per game or for all games.
+
+        Returns:
+            boards (np.array): A 3D-array of shape (nb_games, ROWS, COLS).
+            info (dict): Arrays with the state information of every game:
+                            - done: whether the game is done
+                            - points: the points of both players, (nb_games, 2)
+                            - illegal: whether the game ended on an illegal
+                              move, which the other player wins
+
+        Moves for finished games are ignored. An illegal move (a column
+        outside the grid or a full column) ends the game like
+        play_connect_four does: the other player wins with 5 points.
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        players = np.broadcast_to(np.asarray(players, dtype=np.int64),
+                                  (self.nb_games,))
+        games = np.flatnonzero(~self._done())
+        actions, players = actions[games], players[games]
+
+        in_grid = (actions >= 0) & (actions < self.COLS)
+        columns = np.where(in_grid, actions, 0)
+        legal = in_grid & (self.heights[games, columns] < self.ROWS)
+        bad = games[~legal]
+        self.illegal[bad] = True
+        self.chain_player[bad] = 1 - players[~legal]
+        games, columns, players = games[legal], columns[legal], players[legal]
+
+        rows = self.ROWS - 1 - self.heights[games, columns]
+        digits = players + 1.0
+        self.boards[games, rows, columns] = digits
+        self.heights[games, columns] += 1
+
+        chain = np.ones(len(games), dtype=np.int64)
+        for direction in self.DIRECTIONS:
+            length = np.ones(len(games), dtype=np.int64)
+            for dy, dx in direction:
+                length += self._chain_for_move(games, rows, columns, digits, dy, dx)
+            chain = np.maximum(chain, length)
+
+        longer = chain > self.chain_length[games]
+        self.chain_length[games[longer]] = chain[longer]
+        self.chain_player[games[longer]] = players[longer]
+
+        return self.boards, self._get_info()
+
+    def _chain_for_move(self, games, rows, columns, digits, dy, dx):
+        """Length of the chain of `digits` walking (dy, dx) from each new
+        token, not counting the token itself."""
+        count = np.zeros(len(games), dtype=np.int64)
+        going = np.ones(len(games), dtype=bool)
+        for step in range(1, max(self.ROWS, self.COLS)):
+            y, x = rows + step * dy, columns + step * dx
+            going &= (0 <= y) & (y < self.ROWS) & (0 <= x) & (x < self.COLS)
+            y, x = np.where(going, y, 0), np.where(going, x, 0)
+            going &= self.boards[games, y, x] == digits
+            if not going.any():
+                break
+            count += going
+        return count
+
+    def _done(self):
+        full = self.heights.sum(axis=1) == self.ROWS * self.COLS
+        return full | (self.chain_length >= self.CONNECT) | self.illegal
+
+    def _get_info(self):
+        """Return the state information of every game, see
+        ConnectFour._get_info."""
+        win = (self.chain_length >= self.CONNECT) | self.illegal
+        magnitude = np.where(win, 5, 1)
+        points = np.empty((self.nb_games, 2), dtype=np.int64)
+        points[:, 0] = np.where(self.chain_player == 0, magnitude, -magnitude)
+        points[:, 1] = -points[:, 0]
+        return {
+            'done': self._done(),
+            'points': points,
+            'illegal': self.illegal.copy()
+        }
+
+
 def print_score(winning_player, points_player1, points_player2):
     print(
             'Game is over! Winner: {} || ' 'Current score: Challenger ' '{} -- {} Opponent'.format(winning_player,
@@ -172,23 +311,40 @@ def print_score(winning_player, points_player1, points_player2):
 
 
 
-def play_connect_four(challenger_mover, opponent_mover, nb_games=5):
-    """Play a game, consisting of `nb_games` rounds between two bots.
+def play_game(challenger_mover, opponent_mover, starting_player=0,
+              verbose=True, rows=ConnectFour.ROWS, cols=ConnectFour.COLS,
+              connect=ConnectFour.CONNECT, latencies=None, log=None):
+    """Play a single game between two bots.
 
     Args:
         challenger_mover (function): an implemented generate_move function.
         opponent_mover (function): an implemented generate_move function.
-        nb_games (int): the number of rounds to simulate
+        starting_player (int): 0 if the challenger moves first, 1 otherwise.
+        verbose (bool): print every move and the board after it.
+        rows, cols (int): the size of the grid.
+        connect (int): the chain length that wins. For any other value than
+                       4 it is passed on to the bots as keyword `connect`.
+        latencies (LatencyRecorder): if given, the time of every move is
+                                     recorded in it.
+        log (GameLog): if given, the game is appended to it.
+
+    Returns:
+        winning_player (int): 0 for the challenger, 1 for the opponent.
+        points (int): the points awarded to the winning player.
+        info (dict): the final state information, None if the game
+                     ended with an illegal move or a forfeit.
     """
-    starting_player = np.random.randint(2)
-    total_points = [0, 0]
-    for game_number in range(nb_games):
-        print('\n\n\nGame number: ', game_number+1)
-
-        # Initialize new game
-        connect_four = ConnectFour()
-        challenger_saved_state, opponent_saved_state = None, None
-
+    # Initialize new game
+    connect_four = ConnectFour(rows, cols, connect)
+    options = {} if connect == ConnectFour.CONNECT else {'connect': connect}
+    challenger_saved_state, opponent_saved_state = None, None
+    if log is not None:
+        log.start_game(bot_name(challenger_mover), bot_name(opponent_mover),
+                       starting_player, rows, cols, connect)
+
+    # The bots are told when the game is over, however it ends, so they
+    # can release its state (main_bot stops pondering)
+    try:
         player = starting_player
         info = connect_four._get_info()
 
@@ -202,8 +358,21 @@ def play_connect_four(challenger_mover, opponent_mover, nb_games=5):
 
             # Generate a move with the current player his generator and time it
             start = time.time()
-            result = generator(connect_four.board, player+1, saved_state)
-            move_time = time.time() - start
+            try:
+                result = generator(connect_four.board, player+1, saved_state, **options)
+            # A sandboxed bot that misses its deadline loses the game
+            except Forfeit as e:
+                if verbose:
+                    print(e)
+                if log is not None:
+                    log.record_move(connect_four.board, player + 1, None,
+                                    time.time() - start, bot_name(generator), forfeit=True)
+                    log.end_game((player + 1) % 2, 5)
+                return (player + 1) % 2, 5, None
+            finally:
+                move_time = time.time() - start
+                if latencies is not None:
+                    latencies.record(bot_name(generator), move_time)
 
             # Generator can either return tuple or int
             if isinstance(result, tuple):
@@ -214,44 +383,112 @@ def play_connect_four(challenger_mover, opponent_mover, nb_games=5):
                     challenger_saved_state = saved_state
             else:
                 action = result
+            if log is not None:
+                # a sandboxed bot keeps its saved state, and the report, itself
+                report = getattr(generator, 'last_report', None)
+                if report is None and isinstance(result, tuple):
+                    report = search_report(saved_state)
+                log.record_move(connect_four.board, player + 1, action, move_time,
+                                bot_name(generator), report)
 
             # Print the updated state
-            print('Player {} moved ({:f} seconds)...'.format(
-                player + 1, np.around(move_time, 5)))
+            if verbose:
+                print('Player {} moved ({:f} seconds)...'.format(
+                    player + 1, np.around(move_time, 5)))
             try:
                 connect_four.board, info = connect_four.move(action, player)
             # If an exception occurs, the other player wins the game
             except ConnectFourException as e:
-                print('Illegal move made...', e)
+                if verbose:
+                    print('Illegal move made...', e)
                 winning_player = (player + 1) % 2  # The other player wins
-                total_points[winning_player] += 5
-                print_score(winning_player + 1, total_points[0],
-                            total_points[1])
-                info = None
-                break
-            print(connect_four.board)
-            print('-'*33)
+                if log is not None:
+                    log.end_game(winning_player, 5)
+                return winning_player, 5, None
+            if verbose:
+                print(connect_four.board)
+                print('-'*33)
 
             # Switch player for next turn
             player = (player + 1) % 2
 
         # Points will contain a positive and negative number after the game
         # The index with the positive value corresponds to the winning player.
-        if info is not None:
-            winning_player = np.argmax(info['points'])
-            total_points[winning_player] += info['points'][winning_player]
-            print_score(winning_player + 1, total_points[0], total_points[1])
-
-        # Switch starting player for the next round
-        starting_player = (starting_player + 1) % 2
-
-
-# !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! #
-#        IMPORT YOUR OWN BOT PLAYERS BELOW          #
-# !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! #
+        winning_player = int(np.argmax(info['points']))
+        if log is not None:
+            log.end_game(winning_player, info['points'][winning_player])
+        return winning_player, info['points'][winning_player], info
+    finally:
+        end_game(challenger_mover, challenger_saved_state)
+        end_game(opponent_mover, opponent_saved_state)
+
+
+def play_connect_four(challenger_mover, opponent_mover, nb_games=5,
+                      rows=ConnectFour.ROWS, cols=ConnectFour.COLS,
+                      connect=ConnectFour.CONNECT, deadline=None,
+                      fallback=None, latency_path=None, log_path=None):
+    """Play a game, consisting of `nb_games` rounds between two bots.
 
-from main_bot import generate_move as ai_mover
-from query_bot import generate_move as query_mover
+    Args:
+        challenger_mover (function): an implemented generate_move function.
+        opponent_mover (function): an implemented generate_move function.
+        nb_games (int): the number of rounds to simulate
+        rows, cols, connect (int): the variant to play, see play_game.
+        deadline (float): if given, both bots run in their own subprocess
+                          and a move that takes longer is forfeited, see
+                          bot_sandbox.SandboxedBot.
+        fallback (int or function): the move played instead of forfeiting.
+        latency_path (str): if given, the move latencies of both bots are
+                            written to this file as JSON.
+        log_path (str): if given, every game is appended to this game log,
+                        see game_log.
+
+    Returns:
+        latencies (LatencyRecorder): the move times of both bots.
+    """
+    latencies = LatencyRecorder()
+    movers = [challenger_mover, opponent_mover]
+    if deadline is not None:
+        movers = [SandboxedBot(mover, deadline, fallback, latencies) for mover in movers]
+    log = GameLog(log_path) if log_path is not None else None
+    starting_player = np.random.randint(2)
+    total_points = [0, 0]
+    try:
+        for game_number in range(nb_games):
+            print('\n\n\nGame number: ', game_number+1)
+
+            winning_player, points, info = play_game(
+                movers[0], movers[1], starting_player,
+                rows=rows, cols=cols, connect=connect, latencies=latencies,
+                log=log)
+            total_points[winning_player] += points
+            print_score(winning_player + 1, total_points[0], total_points[1])
 
-# Include two generate_move functions below
-play_connect_four(ai_mover, query_mover)
+            # Switch starting player for the next round
+            starting_player = (starting_player + 1) % 2
+    finally:
+        if deadline is not None:
+            for mover in movers:
+                mover.close()
+        if log is not None:
+            log.close()
+
+    latencies.print_summary()
+    if latency_path is not None:
+        latencies.export(latency_path)
+    return latencies
+
+
+if __name__ == '__main__':
+    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! #
+    #        IMPORT YOUR OWN BOT PLAYERS BELOW          #
+    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! #
+
+    from main_bot import generate_move as ai_mover
+    from query_bot import generate_move as query_mover
+    # or main_bot as a service, see engine_server.py:
+    # from engine_client import EngineClient
+    # ai_mover = EngineClient.spawn().generate_move
+
+    # Include two generate_move functions below
+    play_connect_four(ai_mover, query_mover)
@@ -0,0 +1,131 @@
+'''
+Client side of engine_server, usable as a bot by connectfour_offline.
+
+    from engine_client import EngineClient
+    engine = EngineClient()                 # server started on 127.0.0.1:7474
+    engine = EngineClient.spawn(workers=2)  # or a private server over stdin/stdout
+    play_connect_four(engine.generate_move, opponent_mover)
+
+Every game gets its own server session, kept in saved_state, so the server
+reuses the search tree of the previous move. end_game(session) closes it,
+play_game calls it when the game is over. The module level generate_move
+connects to the server named by the C4_ENGINE variable (host:port).
+'''
+import itertools
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+
+from engine_server import DEFAULT_HOST, DEFAULT_PORT, EngineError
+
+
+class EngineClient(object):
+    '''
+    address: (host, port) of a running engine_server
+    timeout: seconds to wait for an answer, None to wait forever
+    '''
+
+    def __init__(self, address=(DEFAULT_HOST, DEFAULT_PORT), timeout=30.0):
+        self.process = None
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+        if address is not None:
+            self.socket = socket.create_connection(address, timeout=timeout)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.reader = self.socket.makefile('rb')
+            self.writer = self.socket.makefile('wb')
+
+    @classmethod
+    def spawn(cls, workers=None, timeout=30.0):
+        '''
+        Output: EngineClient talking to a new engine_server --stdio process,
+            which ends with the client
+        '''
+        client = cls(address=None, timeout=timeout)
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                'engine_server.py'), '--stdio']
+        if workers:
+            command += ['--workers', str(workers)]
+        client.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        client.socket = None
+        client.reader, client.writer = client.process.stdout, client.process.stdin
+        return client
+
+    def request(self, **message):
+        '''
+        Output: the response (dict) to message, raises EngineError on errors
+        '''
+        message['id'] = next(self.ids)
+        self.writer.write((json.dumps(message) + '\n').encode())
+        self.writer.flush()
+        # requests are sent one at a time, so the next line is the answer
+        if self.socket is None and self.timeout is not None:
+            # a pipe has no timeout of its own
+            ready, _, _ = select.select([self.reader], [], [], self.timeout)
+            if not ready:
+                raise EngineError('no answer within {} seconds'.format(self.timeout))
+        try:
+            line = self.reader.readline()
+        except socket.timeout:
+            raise EngineError('no answer within {} seconds'.format(self.timeout))
+        if not line:
+            raise EngineError('engine closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise EngineError(response['error'])
+        return response
+
+    def new_session(self, connect=4):
+        return self.request(op='new', connect=connect)['session']
+
+    def close_session(self, session):
+        return self.request(op='close', session=session)['ok']
+
+    def move(self, session, board, player):
+        return self.request(op='move', session=session, board=board.tolist(),
+                            player=int(player))['move']
+
+    def generate_move(self, board, player, saved_state=None, connect=4):
+        '''
+        Input: the arguments of main_bot.generate_move
+        Output: (move, saved_state) with saved_state the session of the game
+        '''
+        session = saved_state if saved_state is not None else self.new_session(connect)
+        return self.move(session, board, player), session
+
+    def end_game(self, session):
+        '''
+        Closes the session of a finished game, so the server drops its tree
+        '''
+        self.close_session(session)
+
+    def close(self):
+        self.writer.close()
+        self.reader.close()
+        if self.socket is not None:
+            self.socket.close()
+        if self.process is not None:
+            self.process.wait()
+
+
+_client = None
+
+
+def generate_move(board, player, saved_state=None, connect=4):
+    '''
+    generate_move of the server given by C4_ENGINE (host:port), by default
+    the local one
+    '''
+    global _client
+    if _client is None:
+        host, _, port = os.environ.get('C4_ENGINE', '').rpartition(':')
+        _client = EngineClient((host or DEFAULT_HOST, int(port or DEFAULT_PORT)))
+    return _client.generate_move(board, player, saved_state, connect)
+
+
+def end_game(saved_state):
+    if _client is not None:
+        _client.end_game(saved_state)
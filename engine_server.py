@@ -0,0 +1,311 @@
+'''
+Long-running engine service for main_bot.
+
+Clients talk to the server with one JSON object per line, over a local TCP
+socket or over stdin/stdout (--stdio). Every request carries an "id" that is
+echoed in its response, so a client can play many games over one connection
+and receive the answers out of order.
+
+    {"id": 1, "op": "new", "connect": 4}              -> {"id": 1, "session": "s1"}
+    {"id": 2, "op": "move", "session": "s1",
+     "board": [[0, ...], ...], "player": 1}           -> {"id": 2, "move": 3, "elapsed": 0.91}
+    {"id": 3, "op": "close", "session": "s1"}          -> {"id": 3, "ok": true}
+    {"id": 4, "op": "stats"}                           -> {"id": 4, "workers": [...]}
+
+Errors are answered with {"id": ..., "error": "..."}.
+
+Searches run in a pool of worker processes. A game session sticks to one
+worker, which keeps its MonteCarlo tree (the saved_state of
+main_bot.generate_move) warm between moves. New sessions go to the least
+busy worker. A move for a session whose worker is still busy with other
+games is moved to an idle worker, trading the warm tree for a shorter wait.
+
+    python engine_server.py --port 7474 --workers 4
+'''
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7474
+
+
+class EngineError(Exception):
+    pass
+
+
+def worker_main(conn):
+    '''
+    Input: conn (multiprocessing.Connection) to the server
+    Method: answers ('move', session, board, player, connect) and
+        ('close', session) messages until it receives None. The search
+        state of every session stays in this process.
+    '''
+    import numpy as np
+    import main_bot
+
+    # stdout may be the protocol channel of a --stdio server
+    sys.stdout = sys.stderr
+    states = dict()
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        op, session = message[0], message[1]
+        try:
+            if op == 'move':
+                board, player, connect = message[2:]
+                move, states[session] = main_bot.generate_move(
+                    np.array(board, dtype=float), player, states.get(session), connect)
+                conn.send(('ok', int(move)))
+            elif op == 'close':
+                state = states.pop(session, None)
+                if state is not None:
+                    state.stop_pondering()
+                conn.send(('ok', None))
+            else:
+                conn.send(('error', 'unknown operation {}'.format(op)))
+        except Exception as e:
+            states.pop(session, None)
+            conn.send(('error', '{}: {}'.format(type(e).__name__, e)))
+
+
+class EngineWorker(object):
+    '''
+    One search process. Calls to it are serialised by a single-thread
+    executor, so the event loop never blocks on the pipe.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_main, args=(child,))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = 0
+        self.sessions = set()
+
+    def _call(self, message):
+        self.conn.send(message)
+        return self.conn.recv()
+
+    async def call(self, message):
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            status, value = await loop.run_in_executor(self.executor, self._call, message)
+        finally:
+            self.pending -= 1
+        if status == 'error':
+            raise EngineError(value)
+        return value
+
+    def close(self):
+        try:
+            self.executor.submit(self.conn.send, None).result(timeout=5)
+        except Exception:
+            pass
+        self.executor.shutdown(wait=False)
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class Session(object):
+    __slots__ = ('name', 'worker', 'connect', 'last_used')
+
+    def __init__(self, name, worker, connect):
+        self.name = name
+        self.worker = worker
+        self.connect = connect
+        self.last_used = time.monotonic()
+
+
+class EngineServer(object):
+    '''
+    workers:         number of search processes (None = one per CPU)
+    session_timeout: seconds after which an unused session is dropped
+    migrate:         move a session to an idle worker instead of queueing
+                     behind other games on its own worker
+    '''
+
+    def __init__(self, workers=None, session_timeout=600.0, migrate=True):
+        self.nb_workers = workers or multiprocessing.cpu_count()
+        self.session_timeout = session_timeout
+        self.migrate = migrate
+        self.workers = []
+        self.sessions = dict()
+        self.names = itertools.count(1)
+        self.expiry = None
+
+    def start(self):
+        self.workers = [EngineWorker(index) for index in range(self.nb_workers)]
+        self.expiry = asyncio.ensure_future(self._expire_sessions())
+
+    def least_busy(self):
+        return min(self.workers, key=lambda worker: (worker.pending, len(worker.sessions)))
+
+    async def _expire_sessions(self):
+        while True:
+            await asyncio.sleep(min(60.0, self.session_timeout))
+            now = time.monotonic()
+            for name, session in list(self.sessions.items()):
+                if now - session.last_used > self.session_timeout:
+                    await self.close_session(name)
+
+    async def close_session(self, name):
+        session = self.sessions.pop(name, None)
+        if session is None:
+            return False
+        session.worker.sessions.discard(name)
+        await self._drop(session.worker, name)
+        return True
+
+    async def _drop(self, worker, name):
+        # the tree of a session is gone anyway if its worker died
+        try:
+            await worker.call(('close', name))
+        except Exception:
+            pass
+
+    async def move(self, name, board, player):
+        session = self.sessions.get(name)
+        if session is None:
+            raise EngineError('unknown session {}'.format(name))
+        session.last_used = time.monotonic()
+        worker = session.worker
+        if self.migrate and worker.pending:
+            idle = self.least_busy()
+            if not idle.pending:
+                # the old worker drops the tree once it is done with its queue
+                worker.sessions.discard(name)
+                asyncio.ensure_future(self._drop(worker, name))
+                worker = session.worker = idle
+                worker.sessions.add(name)
+        return await worker.call(('move', name, board, player, session.connect))
+
+    async def handle(self, request, opened):
+        '''
+        Input: request (dict) decoded from one line, opened (set) sessions
+            of the connection
+        Output: response (dict) without the id
+        '''
+        op = request.get('op')
+        if op == 'new':
+            name = 's{}'.format(next(self.names))
+            worker = self.least_busy()
+            worker.sessions.add(name)
+            self.sessions[name] = Session(name, worker, int(request.get('connect', 4)))
+            opened.add(name)
+            return {'session': name}
+        if op == 'move':
+            begin = time.monotonic()
+            move = await self.move(request['session'], request['board'], int(request['player']))
+            return {'move': move, 'elapsed': time.monotonic() - begin}
+        if op == 'close':
+            opened.discard(request['session'])
+            return {'ok': await self.close_session(request['session'])}
+        if op == 'stats':
+            return {'workers': [{'sessions': len(worker.sessions), 'pending': worker.pending}
+                                for worker in self.workers]}
+        raise EngineError('unknown operation {}'.format(op))
+
+    async def respond(self, line, writer, opened):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('expected an object')
+        except ValueError as e:
+            request, response = {}, {'error': 'bad request: {}'.format(e)}
+        else:
+            # every request is answered, also when a worker died (EOFError,
+            # BrokenPipeError), or the client would wait forever
+            try:
+                response = await self.handle(request, opened)
+            except Exception as e:
+                response = {'error': '{}: {}'.format(type(e).__name__, e)}
+        response['id'] = request.get('id')
+        writer.write((json.dumps(response) + '\n').encode())
+        await writer.drain()
+
+    async def serve_stream(self, reader, writer):
+        '''
+        Reads requests from one connection and answers each as soon as it
+        is done. Sessions opened on the connection end with it.
+        '''
+        tasks = set()
+        opened = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.ensure_future(self.respond(line, writer, opened))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            for name in list(opened):
+                await self.close_session(name)
+            writer.close()
+
+    def close(self):
+        if self.expiry is not None:
+            self.expiry.cancel()
+        for worker in self.workers:
+            worker.close()
+
+
+async def stdio_streams():
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, sys.stdout)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, stdio=False, **options):
+    engine = EngineServer(**options)
+    engine.start()
+    try:
+        if stdio:
+            reader, writer = await stdio_streams()
+            await engine.serve_stream(reader, writer)
+        else:
+            server = await asyncio.start_server(engine.serve_stream, host, port)
+            print('Engine listening on {}:{}'.format(host, port), file=sys.stderr)
+            async with server:
+                await server.serve_forever()
+    finally:
+        engine.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve main_bot over a line protocol.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--stdio', action='store_true', help='serve one client on stdin/stdout')
+    parser.add_argument('--workers', type=int, default=None, help='search processes')
+    parser.add_argument('--session-timeout', type=float, default=600.0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.stdio, workers=args.workers,
+                          session_timeout=args.session_timeout))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Append-only log of played games and a streaming analyser for it.
+
+The log is JSON lines, one record per line:
+
+    {"type": "game", "game": ..., "challenger": ..., "opponent": ...,
+     "starting_player": 0, "rows": 6, "cols": 7, "connect": 4}
+    {"type": "move", "game": ..., "ply": 0, "bot": ..., "player": 1,
+     "key": ..., "move": 3, "time": 0.91, "simulations": 12000,
+     "root": [[move, plays, wins], ...], "best_changes": 1}
+    {"type": "result", "game": ..., "winner": 0, "points": 5}
+
+key is bitboard Position.key() of the position before the move, player the
+side to move. simulations, root and best_changes are only there for bots
+that report a search (main_bot). The records of a game are buffered and
+appended with a single write when it ends, so several processes can log to
+one file and the cost per move is one dict and one json.dumps.
+
+Report on a log with:
+    python game_log.py games.jsonl --deadline 1.0 --margin 0.1
+"""
+import argparse
+import gzip
+import heapq
+import itertools
+import json
+import os
+import time
+
+import bitboard as bb
+
+
+def search_report(saved_state):
+    """Return the search statistics a bot left in its saved state.
+
+    Args:
+        saved_state (object): returned by the bot's generate_move, a
+            main_bot.MonteCarlo exposes the SearchStats of its last search
+            as last_search (None for book and solver moves).
+
+    Returns:
+        report (dict): simulations, root as [move, plays, wins] triples and
+            best_changes, or None if there is nothing to report.
+    """
+    stats = getattr(saved_state, 'last_search', None)
+    if stats is None:
+        return None
+    return {
+        'simulations': stats.simulations,
+        'root': [[move, plays, wins] for move, (plays, wins) in sorted(stats.root.items())],
+        'best_changes': stats.best_changes,
+    }
+
+
+class GameLog(object):
+    """Writer appending games to a log file.
+
+    Args:
+        path (str): the log file, created if needed and never truncated.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        # unique across runs appending to the same file
+        self.run = '{:x}{:04x}'.format(int(time.time()), os.getpid() & 0xFFFF)
+        self.games = itertools.count()
+        self.game = None
+        self.connect = 4
+        self.lines = []
+
+    def start_game(self, challenger, opponent, starting_player=0, rows=6, cols=7, connect=4):
+        self.game = '{}-{}'.format(self.run, next(self.games))
+        self.connect = connect
+        self.lines = []
+        self._add({'type': 'game', 'game': self.game, 'challenger': challenger,
+                   'opponent': opponent, 'starting_player': starting_player,
+                   'rows': rows, 'cols': cols, 'connect': connect})
+
+    def record_move(self, board, player, move, think_time, bot, report=None, forfeit=False):
+        """Add the record of one move.
+
+        Args:
+            board (np.array): the board before the move.
+            player (int): the player (1 or 2) to move.
+            move (int): the column played, None if the move was forfeited.
+            think_time (float): seconds the bot took.
+            bot (str): name of the bot.
+            report (dict): see search_report.
+            forfeit (bool): the bot lost the game on this move.
+        """
+        record = {'type': 'move', 'game': self.game, 'ply': int((board != 0).sum()),
+                  'bot': bot, 'player': player,
+                  'key': bb.from_board(board, player, self.connect).key(),
+                  'move': None if move is None else int(move), 'time': think_time}
+        if report is not None:
+            record.update(report)
+        if forfeit:
+            record['forfeit'] = True
+        self._add(record)
+
+    def end_game(self, winner, points):
+        """Add the result and append the game to the file."""
+        self._add({'type': 'result', 'game': self.game, 'winner': int(winner),
+                   'points': int(points)})
+        self.file.write(''.join(self.lines))
+        self.file.flush()
+        self.lines = []
+
+    def _add(self, record):
+        self.lines.append(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+def read_records(paths):
+    """Yield the records of one or more logs (plain or .gz), one at a time.
+    A line cut short by a crashed writer is skipped."""
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def moves(records, bot=None):
+    """Yield the move records, only those of bot if given."""
+    for record in records:
+        if record.get('type') == 'move' and (bot is None or record['bot'] == bot):
+            yield record
+
+
+def near_misses(records, deadline=1.0, margin=0.1):
+    """Yield the moves that took longer than deadline - margin."""
+    for record in moves(records):
+        if record['time'] >= deadline - margin:
+            yield record
+
+
+def changed_mind(records):
+    """Yield the moves during whose search the best move changed."""
+    for record in moves(records):
+        if record.get('best_changes'):
+            yield record
+
+
+class _Top(object):
+    # the count largest items seen, by key
+    def __init__(self, count, key):
+        self.count, self.key = count, key
+        self.heap = []
+        self.order = itertools.count()
+
+    def add(self, item):
+        entry = (self.key(item), next(self.order), item)
+        if len(self.heap) < self.count:
+            heapq.heappush(self.heap, entry)
+        else:
+            heapq.heappushpop(self.heap, entry)
+
+    def items(self):
+        return [item for key, order, item in sorted(self.heap, reverse=True)]
+
+
+def analyse(records, count=10, deadline=1.0, margin=0.1):
+    """Scan records once and collect the reports of the replay tool.
+
+    Args:
+        records (iterable): as yielded by read_records.
+        count (int): length of every top list.
+        deadline (float): seconds allowed per move.
+        margin (float): a move slower than deadline - margin is a near miss.
+
+    Returns:
+        report (dict): numbers of games and moves, the slowest moves, the
+            near misses (count and slowest) and the changed-mind moves
+            (count and those with the most changes).
+    """
+    by_time = lambda record: record['time']
+    slowest, misses = _Top(count, by_time), _Top(count, by_time)
+    changes = _Top(count, lambda record: record['best_changes'])
+    report = {'games': 0, 'moves': 0, 'near_misses': 0, 'timeouts': 0, 'changed_mind': 0}
+    for record in records:
+        kind = record.get('type')
+        if kind == 'game':
+            report['games'] += 1
+        if kind != 'move':
+            continue
+        report['moves'] += 1
+        slowest.add(record)
+        if record['time'] >= deadline - margin:
+            report['near_misses'] += 1
+            if record['time'] > deadline:
+                report['timeouts'] += 1
+            misses.add(record)
+        if record.get('best_changes'):
+            report['changed_mind'] += 1
+            changes.add(record)
+    report['slowest'] = slowest.items()
+    report['slowest_near_misses'] = misses.items()
+    report['most_changed'] = changes.items()
+    return report
+
+
+def format_move(record):
+    line = '{game} ply {ply:>2} {bot} (player {player}) played {move} in {time:.3f} s'.format(**record)
+    if 'simulations' in record:
+        line += ', {} simulations, best move changed {} times'.format(
+            record['simulations'], record['best_changes'])
+    return line + ', key {}'.format(record['key'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report on game logs.')
+    parser.add_argument('paths', nargs='+', help='JSONL logs, optionally gzipped')
+    parser.add_argument('--count', type=int, default=10, help='moves per list')
+    parser.add_argument('--deadline', type=float, default=1.0, help='seconds per move')
+    parser.add_argument('--margin', type=float, default=0.1,
+                        help='report moves slower than deadline - margin')
+    args = parser.parse_args()
+
+    report = analyse(read_records(args.paths), args.count, args.deadline, args.margin)
+    print('{games} games, {moves} moves, {near_misses} near misses ({timeouts} over the '
+          'deadline), {changed_mind} moves where the engine changed its mind'.format(**report))
+    for title, name in (('Slowest moves', 'slowest'),
+                        ('Slowest near misses', 'slowest_near_misses'),
+                        ('Most changes of mind', 'most_changed')):
+        print('\n' + title)
+        for record in report[name]:
+            print('  ' + format_move(record))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,24 @@
 # Adapter for Connect-4 by Maxime Cannoodt & Felix Guo
 
 import numpy as np
+import atexit
 import datetime
-from random import choice
+import multiprocessing
+import random
+import sys
+import threading
+from random import choice, randrange
 from math import log, sqrt
+from time import monotonic, perf_counter
+
+import bitboard as bb
+import board_features
+from time_manager import TimeManager
+import opening_book
+import rollout
+import stats_cache
+from solver import Solver
+from transposition import TranspositionTable
 
 def current_player(board_history):
     '''
@@ -59,7 +74,7 @@ def legal_moves(board):
     # Takes a sequence of game states representing the full
     # game history, and returns the full list of moves that
     # are legal plays for the current player.
-    return np.arange(board.shape[1])[np.sum(board == 0, axis=0) > 0].tolist()
+    return board_features.legal_moves(board).tolist()
 
 
 def state_to_str(board):
@@ -69,38 +84,39 @@ def state_to_str(board):
     return ''.join(board)
 
 
-def str_to_state(str):
-    if len(str) == 6 * 7:
+def str_to_state(str, rows=6, cols=7):
+    if len(str) == rows * cols:
         out = np.array([c for c in str])
-        return out.reshape((6, 7)).astype(float)
+        return out.reshape((rows, cols)).astype(float)
 
 
-def scan_board(board):
+def scan_board(board, length=4):
     # Generator for all 4-in-a-row states (inspired by https://gist.github.com/poke/6934842)
     '''
-    Input: board (np.array)
-    Assumes: board.shape[0] > 3 and board.shape[1] > 3
-    Method: creates a set for all 4-in-a-row shapes on the board.
+    Input: board (np.array), length (int) of the rows to win
+    Assumes: board.shape[0] >= length and board.shape[1] >= length
+    Method: creates a set for all length-in-a-row shapes on the board.
     '''
     rows, cols  = board.shape
-    horizontals = [board[row, col_start:col_start+4] for row in range(rows) for col_start in range(0, cols-3)]
-    verticals = [board[row_start:row_start+4, col] for col in range(cols) for row_start in range(0, rows-3)]
-    up_diags = [np.array([board[start_row-i, start_col+i] for i in range(4)]) for start_row in range(3, rows) for start_col in range(cols-3)]
-    down_diags = [np.array([board[start_row+i, start_col+i] for i in range(4)]) for start_row in range(3) for start_col in range(cols-3)]
+    n = length
+    horizontals = [board[row, col_start:col_start+n] for row in range(rows) for col_start in range(0, cols-n+1)]
+    verticals = [board[row_start:row_start+n, col] for col in range(cols) for row_start in range(0, rows-n+1)]
+    up_diags = [np.array([board[start_row-i, start_col+i] for i in range(n)]) for start_row in range(n-1, rows) for start_col in range(cols-n+1)]
+    down_diags = [np.array([board[start_row+i, start_col+i] for i in range(n)]) for start_row in range(rows-n+1) for start_col in range(cols-n+1)]
     return horizontals + verticals + up_diags + down_diags
 
 
-def find_winner(board):
+def find_winner(board, length=4):
     '''
-    Input: board (np.array)
+    Input: board (np.array), length (int) of the rows to win
     Output:
         0 if no winner,
         1 if player 1 wins,
         2 if player 2 wins,
         -1 if tie. (full board)
     '''
-    for test in scan_board(board):
-        if len(np.where(test)[0]) == 4:
+    for test in scan_board(board, length):
+        if len(np.where(test)[0]) == length:
             # if a winner is found
             if np.all(test == test[0]):
                 return test[0]
@@ -111,159 +127,870 @@ def find_winner(board):
         return 0
 
 
-class MonteCarlo(object):
-    def __init__(self, board, **kwargs):
-        # Takes an instance of a board and optionally some keyword
-        # arguments.  Initializes the list of game states and the
-        # statistics tables.
-        self.board_history = kwargs.get('board_history', list())
-        self.calculation_time = datetime.timedelta(seconds=kwargs.get('time', 0.5))
-        self.max_moves = kwargs.get('max_moves', 100)
-        self.C = kwargs.get('C', 1.4)
+class Node(object):
+    '''
+    Search tree node for one position. Transpositions share a node, so the
+    move leading into it is stored on the parent's children dict. With
+    canonical set, mirror images share a node too and its moves are those
+    of the position in the frame of bitboard Position.canonical().
+
+    player:   number of the player who moved into this position
+    plays:    number of simulations that passed through this node
+    wins:     number of those simulations won by player
+    children: dict mapping moves to expanded child nodes
+    untried:  legal moves that have no child node yet
+    winner:   result of the game if the last move ended it (see find_winner), else 0
+    '''
+    __slots__ = ('player', 'plays', 'wins', 'children', 'untried', 'winner')
+
+    def __init__(self, player, position, winner=0, canonical=False):
+        self.player = player
+        self.plays = 0
+        self.wins = 0
+        self.children = dict()
+        if winner:
+            self.untried = []
+        elif canonical:
+            self.untried = position.canonical_moves()
+        else:
+            self.untried = position.legal_moves()
+        self.winner = winner
+
+
+def tree_nodes(root):
+    '''
+    Input: root (Node)
+    Output: dict mapping id() to node for every node reachable from root,
+        nodes shared by transpositions appear once
+    '''
+    nodes = {id(root): root}
+    stack = [root]
+    while stack:
+        for child in stack.pop().children.values():
+            if id(child) not in nodes:
+                nodes[id(child)] = child
+                stack.append(child)
+    return nodes
 
-        self.wins = kwargs.get('wins', dict())
-        self.plays = kwargs.get('plays', dict())
 
+def tree_size(root):
+    '''
+    Input: root (Node)
+    Output: (number of nodes, approximate memory in bytes) of the tree below root
+    '''
+    nodes = tree_nodes(root).values()
+    size = sum(sys.getsizeof(node) + sys.getsizeof(node.children)
+               + sys.getsizeof(node.untried) for node in nodes)
+    return len(nodes), size
 
-    def update(self, board):
-        # Takes a game state, and appends it to the history.
-        self.board_history.append(board)
 
+PHASES = ('selection', 'expansion', 'rollout', 'backpropagation')
 
-    def get_play(self):
-        # Causes the AI to calculate the best move from the
-        # current game state and return it.
+
+class SearchStats(object):
+    '''
+    Statistics of one call to MonteCarlo.get_play.
+
+    move:           the move that was chosen
+    simulations:    number of simulations, including those of the workers
+    nodes_created:  number of new tree nodes expanded by this process
+    max_depth:      deepest path from the root (in nodes) of any simulation
+    total_depth:    sum of those path lengths, see avg_depth
+    elapsed:        wall-clock seconds spent searching
+    budget:         soft time budget of the search in seconds
+    best_changes:   how often the best root move changed during the search
+    phase_times:    dict mapping each of PHASES to the seconds spent in it
+    root:           dict mapping every root move to its (plays, wins)
+    table:          transposition table counters, see TranspositionTable.stats
+    '''
+    __slots__ = ('move', 'simulations', 'nodes_created', 'max_depth',
+                 'total_depth', 'elapsed', 'budget', 'best_changes',
+                 'phase_times', 'root', 'table',
+                 '_tree_root', '_tree_size')
+
+    def __init__(self, tree_root=None):
+        self.move = None
+        self.simulations = 0
+        self.nodes_created = 0
         self.max_depth = 0
-        state = self.board_history[-1]
-        player = current_player(self.board_history)
-        legal = legal_moves(state)
+        self.total_depth = 0
+        self.elapsed = 0.0
+        self.budget = 0.0
+        self.best_changes = 0
+        self.phase_times = dict.fromkeys(PHASES, 0.0)
+        self.root = dict()
+        self.table = dict()
+        self._tree_root = tree_root
+        self._tree_size = None
+
+    @property
+    def avg_depth(self):
+        return self.total_depth / self.simulations if self.simulations else 0.0
+
+    @property
+    def simulations_per_second(self):
+        return self.simulations / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def tree_size(self):
+        # (nodes, bytes) of the search tree, computed on first access
+        # since it walks the whole tree
+        if self._tree_size is None:
+            self._tree_size = tree_size(self._tree_root) if self._tree_root else (0, 0)
+        return self._tree_size
+
+    def as_dict(self):
+        nodes, size = self.tree_size
+        return {
+            'move': self.move,
+            'simulations': self.simulations,
+            'nodes_created': self.nodes_created,
+            'tree_nodes': nodes,
+            'tree_bytes': size,
+            'max_depth': self.max_depth,
+            'avg_depth': self.avg_depth,
+            'elapsed': self.elapsed,
+            'budget': self.budget,
+            'best_changes': self.best_changes,
+            'simulations_per_second': self.simulations_per_second,
+            'phase_times': dict(self.phase_times),
+            'root': dict((move, list(stats)) for move, stats in self.root.items()),
+            'table': dict(self.table),
+        }
+
+
+def print_stats(stats):
+    '''
+    Reporter that prints a SearchStats the way get_play used to.
+    '''
+    print(stats.simulations, datetime.timedelta(seconds=stats.elapsed))
+    # Display the stats for each legal move possible
+    for x in sorted(
+            ((100 * wins / (plays or 1), wins, plays, p)
+             for p, (plays, wins) in stats.root.items()),
+            reverse=True
+    ):
+        print('Column {3}: {0:.2f}% ({1} / {2})'.format(*x))
+    print('Max depth searched:', stats.max_depth)
+    nodes, size = stats.tree_size
+    print('Tree size: {} nodes ({:.1f} KiB)'.format(nodes, size / 1024))
+    if stats.table:
+        print('Transposition table: {size}/{capacity} entries, {hits} hits, '
+              '{misses} misses, {evictions} evictions'.format(**stats.table))
+    print('Time per phase: ' + ', '.join(
+        '{} {:.3f}s'.format(phase, stats.phase_times[phase]) for phase in PHASES))
+
+
+class MonteCarlo(object):
+    def __init__(self, position, **kwargs):
+        # Takes a bitboard Position and optionally some keyword
+        # arguments.  Initializes the search tree at that position.
+        self.calculation_time = datetime.timedelta(seconds=kwargs.get('time', 0.5))
+        self.max_moves = kwargs.get('max_moves', 100)
+        self.C = kwargs.get('C', 1.4)
+        # number of extra processes searching the root in parallel
+        self.workers = kwargs.get('workers', 0)
+        # leaves played out per vectorized rollout batch (0 = one at a time).
+        # Batches pay off from about 256 leaves on boards of up to 64 bits
+        # (6x7, 7x8), where they run about 1.5-2x the simulations per second
+        # of scalar search; 64 leaves only break even. Wider boards use
+        # NumPy object arrays, threat rollouts are then faster one at a time.
+        self.batch = kwargs.get('batch', 0)
+        # 'threats' rollouts take immediate wins and block immediate losses,
+        # 'uniform' rollouts pick every legal move with equal probability
+        self.rollout_policy = kwargs.get('rollout_policy', 'threats')
+        # reporter(stats) is called with the SearchStats of every search,
+        # hook(event, stats) with 'start', 'simulation' and 'end' events
+        self.reporter = kwargs.get('reporter', None)
+        self.hooks = kwargs.get('hooks', [])
+        # optional TimeManager deciding when to stop searching, the clock
+        # is read once every check_every simulations
+        self.time_manager = kwargs.get('time_manager', None)
+        self.check_every = kwargs.get('check_every', 32)
+        # pondering on the opponent's turn lasts twice the expected think
+        # time of the opponent (seconds, a running average of the observed
+        # ones), and never longer than ponder_time
+        self.ponder_time = kwargs.get('ponder_time', 5.0)
+        self.opponent_time = kwargs.get('opponent_time', self.calculation_time.total_seconds())
+        self.ponder_started = None
+        self.ponder_thread = None
+        self.ponder_stop = threading.Event()
+        self.ponder_stats = None
+        # SearchStats of the search behind the last move of generate_move,
+        # None if the move came from the book or the solver
+        self.last_search = None
+
+        # Nodes are shared between transpositions through this table, and
+        # every node of the tree is registered in it. Once it holds tt_size
+        # entries, new positions are still played out but no longer kept,
+        # so tt_size bounds the size of the tree. With symmetry mirror
+        # images share their node and their table entry, see table_key.
+        self.symmetry = kwargs.get('symmetry', True)
+        self.table = TranspositionTable(kwargs.get('tt_size', 200000))
+        # exact endgame solver, kept here so its table lives as long as the tree
+        self.solver = Solver(kwargs.get('solver_tt_size', 500000))
+        self.set_root(position, Node(3 - position.player, position, 0, self.symmetry))
+        self.stats = SearchStats(self.root)
+        # (plays, wins) per position key already counted in a StatsCache
+        self.exported = dict()
+
+
+    def table_key(self, position):
+        # Returns (key, mirrored): the key of position in the table and
+        # whether the tree sees position mirrored, in which case moves of
+        # the game map to COLS - 1 - move in the tree and back.
+        if self.symmetry:
+            return position.canonical()
+        return position.key(), False
+
+
+    def set_root(self, position, node):
+        # Makes node (for position) the root of the search and registers it.
+        self.position, self.root = position, node
+        self.table.store(self.table_key(position)[0], node)
+
+
+    def root_children(self):
+        # root.children keyed by the moves of the game.
+        if not self.table_key(self.position)[1]:
+            return self.root.children
+        last = self.position.COLS - 1
+        return dict((last - move, child) for move, child in self.root.children.items())
+
+
+    def symmetric_root(self):
+        # True if the root is its own mirror image, its tree then only
+        # holds the moves of the left half and the centre.
+        key = self.position.key()
+        return self.symmetry and bb.mirror(key, table=self.position.MIRROR) == key
+
+
+    def update(self, position):
+        # Takes the actual game state and re-roots the tree on it.
+        # The previous search is kept if position is the root or one of
+        # its children (the opponent's reply), otherwise the tree is
+        # rebuilt. Subtrees that became unreachable are dropped, together
+        # with their table entries.
+        if position.key() == self.position.key() and position.player == self.position.player:
+            return
+        key = self.table_key(position)[0]
+        for move, child in self.root_children().items():
+            candidate = bb.next_state(self.position, move)
+            if self.table_key(candidate)[0] == key and candidate.player == position.player:
+                self.set_root(position, child)
+                reachable = tree_nodes(child)
+                self.table.prune(lambda node: id(node) in reachable)
+                return
+        self.table.clear()
+        self.exported.clear()
+        self.set_root(position, Node(3 - position.player, position, 0, self.symmetry))
+
+
+    def advance(self, move):
+        # Plays move from the root and keeps the matching subtree.
+        children = self.root_children()
+        child = children.get(move)
+        if child is None and self.symmetric_root():
+            child = children.get(self.position.COLS - 1 - move)
+        position = bb.next_state(self.position, move)
+        if child is None:
+            child = Node(self.position.player, position, 0, self.symmetry)
+        self.set_root(position, child)
+
+
+    def seed_from(self, cache, prior=1000):
+        # Warm-starts the root from a stats_cache.StatsCache: every root
+        # move without a child node gets one holding the cached (plays,
+        # wins) of its position, scaled down to at most `prior` plays so
+        # the new search can still overrule them.
+        position = self.position
+        root = self.root
+        last = position.COLS - 1
+        mirrored = self.table_key(position)[1]
+        for move in list(root.untried):
+            if self.table.is_full():
+                break
+            played = last - move if mirrored else move
+            child_position = bb.next_state(position, played)
+            key = self.table_key(child_position)[0]
+            cached = cache.lookup(key)
+            if cached is None or not cached[0]:
+                continue
+            plays, wins = cached
+            if plays > prior:
+                plays, wins = prior, int(round(wins * prior / plays))
+            winner = position.player if position.is_winning_move(played) else 0
+            child = Node(position.player, child_position, winner, self.symmetry)
+            child.plays, child.wins = plays, wins
+            root.untried.remove(move)
+            root.children[move] = child
+            root.plays += plays
+            self.table.store(key, child)
+            self.exported[key] = (plays, wins)
+
+
+    def export_to(self, cache, depth=2, min_plays=50):
+        # Adds the simulations the tree gained since the last export to a
+        # stats_cache.StatsCache, for the nodes up to `depth` plies below
+        # the root with at least `min_plays` plays.
+        exported = self.exported
+        frontier = [(self.position, self.root)]
+        for ply in range(depth):
+            next_frontier = []
+            for position, node in frontier:
+                last = position.COLS - 1
+                mirrored = self.table_key(position)[1]
+                for move, child in node.children.items():
+                    if child.plays < min_plays:
+                        continue
+                    child_position = bb.next_state(position, last - move if mirrored else move)
+                    key = self.table_key(child_position)[0]
+                    plays, wins = exported.get(key, (0, 0))
+                    if child.plays > plays:
+                        cache.record(key, child.plays - plays, max(0, child.wins - wins))
+                        exported[key] = (child.plays, child.wins)
+                    next_frontier.append((child_position, child))
+            frontier = next_frontier
+
+
+    def get_play(self, time_limit=None):
+        # Causes the AI to calculate the best move from the
+        # current game state and return it, together with the
+        # SearchStats of the search. time_limit (seconds) overrides
+        # the hyperparameter 'time' as the hard limit for this move.
+        root = self.root
+        stats = self.stats = SearchStats(root)
+        legal = self.position.legal_moves()
 
         # If there's no legal moves, don't bother
         if not legal:
-            return
+            return None, stats
         # if there's only one choice anyways
         if len(legal) == 1:
-            return legal[0]
+            stats.move = legal[0]
+            return legal[0], stats
+
+        begin = monotonic()
+        limit = self.calculation_time.total_seconds() if time_limit is None else time_limit
+        budget = limit
+        if self.time_manager is not None:
+            budget = self.time_manager.budget(self.position, legal, limit)
+        for hook in self.hooks:
+            hook('start', stats)
+
+        # Root parallelism: the workers search the same position with their
+        # own trees while this process keeps searching its reused tree.
+        pending = None
+        if self.workers:
+            position = self.position
+            options = {'max_moves': self.max_moves, 'C': self.C,
+                       'tt_size': self.table.capacity, 'batch': self.batch,
+                       'check_every': self.check_every,
+                       'rollout_policy': self.rollout_policy,
+                       'symmetry': self.symmetry}
+            geometry = (position.ROWS, position.COLS, position.CONNECT)
+            job = (position.current, position.mask, position.moves,
+                   position.player, geometry, budget, options)
+            pending = get_pool(self.workers).map_async(
+                search_worker, [job] * self.workers)
 
-        games = 0
-        begin = datetime.datetime.utcnow()
         # Runs simulations as long as is allowed by hyperparameter 'time'
         # this should be less than 1.0 sec to conform to competition rules.
-        while datetime.datetime.utcnow() - begin <self.calculation_time:
-            self.run_simulation()
-            games += 1
+        self.search(limit)
+
+        # (plays, wins) per move, summed over this process and the workers
+        totals = dict((p, [child.plays, child.wins])
+                      for p, child in self.root_children().items())
+        if pending is not None:
+            for worker_stats in pending.get():
+                stats.simulations += worker_stats.simulations
+                stats.max_depth = max(stats.max_depth, worker_stats.max_depth)
+                stats.total_depth += worker_stats.total_depth
+                for p, (plays, wins) in worker_stats.root.items():
+                    total = totals.setdefault(p, [0, 0])
+                    total[0] += plays
+                    total[1] += wins
+
+        # the mirrored moves of a symmetric root share their statistics
+        if self.symmetric_root():
+            last = self.position.COLS - 1
+            for p in list(totals):
+                totals.setdefault(last - p, totals[p])
+
+        stats.elapsed = monotonic() - begin
+        stats.budget = budget
+        stats.root = dict((p, tuple(totals[p])) for p in legal if p in totals)
+        stats.table = self.table.stats()
+        if self.time_manager is not None:
+            stats.best_changes = self.time_manager.changes
+
+        # pick the most simulated move (ties go to the higher win rate),
+        # which is also what the time manager's early stop relies on
+        plays, win_rate, move = max(
+            (plays, wins / (plays or 1), p)
+            for p, (plays, wins) in stats.root.items()
+        )
+        stats.move = move
+
+        for hook in self.hooks:
+            hook('end', stats)
+        if self.reporter is not None:
+            self.reporter(stats)
+        return move, stats
+
+
+    def search(self, seconds, stop=None, manage=True, until_full=False):
+        # Runs simulations for at most `seconds`. The clock is only read
+        # every check_every simulations (every batch in batch mode), and
+        # the time manager, if any and manage is set, may end the search
+        # earlier. Setting the `stop` event, or with until_full the table
+        # (and so the tree) filling up, ends it at the next check.
+        hooks, stats = self.hooks, self.stats
+        manager = self.time_manager if manage else None
+        checks = 1 if self.batch else self.check_every
+        start = monotonic()
+        deadline = start + seconds
+        while True:
+            for i in range(checks):
+                if self.batch:
+                    self.run_batch(self.batch)
+                else:
+                    self.run_simulation()
+                for hook in hooks:
+                    hook('simulation', stats)
+            now = monotonic()
+            if now >= deadline:
+                break
+            if stop is not None and stop.is_set():
+                break
+            if until_full and self.table.is_full():
+                break
+            if manager is not None and manager.should_stop(
+                    self.root, now - start, deadline - now, stats.simulations):
+                break
 
-        moves_states = [(move, state_to_str(next_state(self.board_history, move))) for move in legal]
 
-        # Print the number of simulations ran and time elapsed
-        print(games, datetime.datetime.utcnow() - begin)
+    def start_pondering(self):
+        # Keeps searching the current root (the position after our move)
+        # on a background thread while the opponent thinks. The thread
+        # shares the GIL, so this only pays off when the opponent runs in
+        # another process.
+        if self.ponder_thread is not None or self.root.winner:
+            return
+        self.ponder_stop.clear()
+        self.ponder_started = monotonic()
+        seconds = min(self.ponder_time, 2 * self.opponent_time)
+        self.ponder_thread = threading.Thread(target=self.ponder, args=(seconds,))
+        self.ponder_thread.daemon = True
+        self.ponder_thread.start()
 
-        # pick the move with the highest percentage of wins
-        win_rate, move = max(
-            (self.wins.get((player, S), 0) /
-             self.plays.get((player, S), 1),
-             p)
-            for p, S in moves_states
-        )
 
-        # Display the stats for each legal move possible
-        for x in sorted(
-                ((100 * self.wins.get((player, S), 0) /
-                      self.plays.get((player, S), 1),
-                  self.wins.get((player, S), 0),
-                  self.plays.get((player, S), 0), p)
-                 for p, S in moves_states),
-                reverse=True
-        ):
-            print('Column {3}: {0:.2f}% ({1} / {2})'.format(*x))
+    def ponder(self, seconds):
+        # Body of the pondering thread: searches until stop_pondering() is
+        # called, `seconds` run out or the table is full.
+        self.stats = self.ponder_stats = SearchStats(self.root)
+        self.search(seconds, stop=self.ponder_stop, manage=False, until_full=True)
 
-        print('Max depth searched:', self.max_depth)
 
-        return move
+    def stop_pondering(self):
+        # Stops the pondering thread, its statistics stay in the tree. The
+        # time since start_pondering() is how long the opponent thought.
+        if self.ponder_thread is None:
+            return
+        self.opponent_time = (self.opponent_time + monotonic() - self.ponder_started) / 2
+        self.ponder_stop.set()
+        self.ponder_thread.join()
+        self.ponder_thread = None
 
 
     def run_simulation(self):
-        # Plays out a "random" game from the current position,
-        # then updates the statistics tables with the result.
-        plays, wins = self.plays, self.wins
+        # Walks down the tree with UCB1, expands one new node and plays
+        # out a "random" game from there, then updates the statistics of
+        # every node on the path with the result.
+        path, position = self.select()
+        winner = path[-1].winner
+        times = self.stats.phase_times
+        start = perf_counter()
+
+        # Simulation
+        if self.rollout_policy == 'threats' and not winner:
+            winner = self.threat_rollout(position)
+        else:
+            for i in range(self.max_moves):
+                if winner:
+                    break
+                move = choice(position.legal_moves())
+                if position.is_winning_move(move):
+                    winner = position.player
+                    break
+                position.play(move)
+                if position.moves == position.CELLS:
+                    winner = -1
+        end = perf_counter()
+        times['rollout'] += end - start
+
+        # Backpropagation
+        for node in path:
+            # update occurrence value for given game state
+            node.plays += 1
+            # if game state led to a win for this player,
+            # update win value for given game state
+            if node.player == winner:
+                node.wins += 1
+        times['backpropagation'] += perf_counter() - end
+        self.stats.simulations += 1
+
+
+    def threat_rollout(self, position):
+        # Plays out position with the threat table: wins when a winning
+        # cell is playable, blocks the opponent's playable winning cell,
+        # and otherwise plays a uniformly random legal move.
+        # Returns the winner (1 or 2), -1 for a draw or 0 if max_moves ran out.
+        table = bb.ThreatTable(position)
+        threats = table.threats
+        for i in range(self.max_moves):
+            player = position.player
+            playable = (position.mask + position.BOTTOM_MASK) & position.BOARD_MASK
+            if threats[player] & playable:
+                return player
+            forced = threats[3 - player] & playable
+            if forced:
+                move = ((forced & -forced).bit_length() - 1) // position.H1
+            else:
+                move = choice(position.legal_moves())
+            # only a threat cell wins, so table.play cannot report a win here
+            table.play(position, move)
+            position.play(move)
+            if position.moves == position.CELLS:
+                return -1
+        return 0
 
-        visited_states = set()
-        history_copy = self.board_history[:]
-        player = current_player(history_copy)
 
-        expand = True
-        for i in range(self.max_moves):
-            legal = legal_moves(history_copy[-1])
-            move_states = [(p, state_to_str(next_state(history_copy, p))) for p in legal]
-
-            if all(plays.get((player, S)) for p, S in move_states):
-                # If there are statistics on all of the legal moves, use them.
-                # applies the UCB1 formula: xi +- sqrt( 2 ln(n) / ni ) with:
-                # xi = mean payout for move i
-                # ni = #plays on move i
-                # n  = #plays in total
-                log_total = log(sum(plays[(player, S)] for p, S in move_states))
-                value, move, state = max(
-                    ((wins[(player, S)] / plays[(player, S)]) +
-                     self.C * sqrt(log_total / plays[(player, S)]), p, S)
-                    for p, S in move_states
-                )
+    def run_batch(self, size):
+        # Selects `size` leaves, plays them all out at once with the
+        # vectorized rollout engine and backs up every result. Plays are
+        # counted while selecting (a virtual loss), which steers the next
+        # selections of the same batch towards other leaves.
+        leaves = []
+        for i in range(size):
+            path, position = self.select()
+            for node in path:
+                node.plays += 1
+            leaves.append((path, position))
+
+        times = self.stats.phase_times
+        start = perf_counter()
+        open_leaves = [(path, position) for path, position in leaves
+                       if not path[-1].winner]
+        if open_leaves:
+            results = rollout.batch_rollout(
+                [position.current for path, position in open_leaves],
+                [position.mask for path, position in open_leaves],
+                [position.moves for path, position in open_leaves],
+                [position.player for path, position in open_leaves],
+                self.rollout_policy, type(self.position)).tolist()
+        else:
+            results = []
+        end = perf_counter()
+        times['rollout'] += end - start
+
+        outcomes = [(path, path[-1].winner) for path, position in leaves
+                    if path[-1].winner]
+        outcomes += [(path, winner) for (path, position), winner
+                     in zip(open_leaves, results)]
+        for path, winner in outcomes:
+            for node in path:
+                if node.player == winner:
+                    node.wins += 1
+        times['backpropagation'] += perf_counter() - end
+        self.stats.simulations += size
+
+
+    def select(self):
+        # Selection and expansion: walks down the tree with UCB1 and
+        # expands one new node. Returns the path of nodes from the root
+        # and the position at its end.
+        node = self.root
+        position = self.position.copy()
+        path = [node]
+        C = self.C
+        stats = self.stats
+        start = perf_counter()
+        # moves in the tree are mirrored while the position is
+        symmetry = self.symmetry
+        last = position.COLS - 1
+        mirrored = symmetry and position.canonical()[1]
+
+        # Selection
+        while not node.untried and node.children:
+            # applies the UCB1 formula: xi +- sqrt( 2 ln(n) / ni ) with:
+            # xi = mean payout for move i
+            # ni = #plays on move i
+            # n  = #plays in total
+            log_total = log(node.plays)
+            best_value = -1.0
+            for child_move, child in node.children.items():
+                value = (child.wins / child.plays) + C * sqrt(log_total / child.plays)
+                if value > best_value:
+                    best_value, move, best = value, child_move, child
+            # a node shared through the table may have been created by
+            # another move, so play the move of the edge that was followed
+            node = best
+            position.play(last - move if mirrored else move)
+            if symmetry:
+                mirrored = position.canonical()[1]
+            path.append(node)
+        end = perf_counter()
+        stats.phase_times['selection'] += end - start
+
+        # Expansion
+        if node.untried:
+            table = self.table
+            keep = not table.is_full()
+            index = randrange(len(node.untried))
+            move = node.untried[index]
+            played = last - move if mirrored else move
+            player = position.player
+            # only the lines through the new stone can complete a four
+            won = position.is_winning_move(played)
+            position.play(played)
+            if won:
+                winner = player
+            elif position.moves == position.CELLS:
+                winner = -1
             else:
-                # If there are no stats on this move, make an arbitrary decision
-                move, state = choice(move_states)
-
-            history_copy.append(str_to_state(state))
-
-            # add dictionary entries for newly found game state
-            if expand and (player, state) not in self.plays:
-                expand = False
-                self.plays[(player, state)] = 0
-                self.wins[(player, state)] = 0
-                if i > self.max_depth:
-                    self.max_depth = i
-
-            visited_states.add((player, state))
-            history_copy.append(str_to_state(state))
-            player = current_player(history_copy)
-            winner = find_winner(str_to_state(state))
-            if winner:
-                break
+                winner = 0
+            # reuse the node of a transposition (or of the mirror image)
+            # if the table knows it
+            key = self.table_key(position)[0]
+            child = table.get(key)
+            if child is None:
+                child = Node(player, position, winner, symmetry)
+                if keep:
+                    table.store(key, child)
+                    stats.nodes_created += 1
+            else:
+                keep = True
+            # with the table full a new node only lives for this
+            # simulation and the move stays untried
+            if keep:
+                del node.untried[index]
+                node.children[move] = child
+            path.append(child)
+        stats.phase_times['expansion'] += perf_counter() - end
 
-        for (player, state) in visited_states:
-            if (player, state) not in self.plays:
-                continue # move along, nothing to see here
+        depth = len(path)
+        stats.total_depth += depth
+        if depth > stats.max_depth:
+            stats.max_depth = depth
+        return path, position
 
-            # update occurrence value for given game state
-            self.plays[(player, state)] += 1
-            # if game state led to a win for this player,
-            # update win value for given game state
-            if player == winner:
-                self.wins[(player, state)] += 1
+
+_pools = dict()
+
+
+def get_pool(workers):
+    '''
+    Input: workers (int) number of processes
+    Output: a multiprocessing.Pool of that size. Pools are created on first
+        use and kept alive between moves so process startup is paid once.
+        Every size has its own pool, so a caller asking for another size
+        (the search and analyse_positions) never ends a pool in use.
+    '''
+    pool = _pools.get(workers)
+    if pool is None:
+        pool = _pools[workers] = multiprocessing.Pool(workers, initializer=seed_worker)
+    return pool
+
+
+def seed_worker():
+    # Forked workers inherit the random states of this process, reseed
+    # both generators so every worker plays different rollouts.
+    random.seed()
+    rollout.seed()
 
 
-def generate_move(board, player, saved_state=None):
+def close_pool(workers=None):
+    '''
+    Terminates the pool of the given size, or all pools if workers is None.
+    '''
+    for size in ([workers] if workers is not None else list(_pools)):
+        pool = _pools.pop(size, None)
+        if pool is not None:
+            pool.terminate()
+
+
+atexit.register(close_pool)
+
+
+def search_worker(job):
+    '''
+    Input: job (tuple) of the root Position fields, the board geometry
+        (rows, cols, connect), the search time in seconds and the
+        MonteCarlo keyword arguments
+    Method: runs simulations on a fresh tree for the given time
+    Output: SearchStats of the worker, root holds the (plays, wins)
+        of each root move
+    '''
+    current, mask, moves, player, geometry, seconds, options = job
+    position_class = bb.board_class(*geometry)
+    AI = MonteCarlo(position_class(current, mask, moves, player), **options)
+    AI.search(seconds)
+    stats = AI.stats
+    stats.root = dict((p, (child.plays, child.wins))
+                      for p, child in AI.root_children().items())
+    # the tree stays in the worker, only the numbers are sent back
+    stats._tree_root = None
+    return stats
+
+
+def analysis_worker(job):
+    '''
+    Input: job (tuple) of (index, board, player to move or None, connect
+        length, search time in seconds, MonteCarlo keyword arguments)
+    Output: (index, analysis dict), see analyse_positions
+    '''
+    index, board, player, connect, seconds, options = job
+    if player is None:
+        player = bb.side_to_move(board)
+    position = bb.from_board(board, player, connect)
+    visits = [0] * position.COLS
+    win_rates = [None] * position.COLS
+    analysis = {'player': player, 'visits': visits, 'win_rates': win_rates,
+                'best_move': None, 'simulations': 0,
+                'winner': int(find_winner(board, connect))}
+    if analysis['winner']:
+        return index, analysis
+
+    AI = MonteCarlo(position, **options)
+    AI.search(seconds)
+    for move, child in AI.root_children().items():
+        visits[move] = child.plays
+        win_rates[move] = child.wins / child.plays if child.plays else None
+    if AI.symmetric_root():
+        # a symmetric position only searches the left half of its moves
+        last = position.COLS - 1
+        for move in range(position.COLS // 2):
+            visits[last - move], win_rates[last - move] = visits[move], win_rates[move]
+    analysis['simulations'] = AI.stats.simulations
+    legal = position.legal_moves()
+    analysis['best_move'] = max(legal, key=lambda move: (visits[move], win_rates[move] or 0))
+    return index, analysis
+
+
+def analyse_positions(boards, seconds=1.0, processes=None, players=None, connect=4,
+                      **options):
+    '''
+    Input: boards (iterable of np.array) in the referee's format, of any
+        size, seconds (float) search time per position, processes (int) pool
+        size (None = one per CPU), players (list) optional player to move per
+        board, connect (int) stones in a row needed to win, options are
+        passed on to MonteCarlo
+    Method: searches every board on its own tree in the shared process pool,
+        the player to move is derived from the board unless given
+    Output: generator of (index, analysis) in order of completion, where
+        analysis holds 'player', 'visits' and 'win_rates' per column (win
+        rate for the player to move, None for unexplored columns),
+        'best_move', 'simulations' and 'winner' (non-zero if the board is
+        already decided, nothing is searched then)
+    '''
+    jobs = ((index, np.asarray(board), players[index] if players else None,
+             connect, seconds, options) for index, board in enumerate(boards))
+    pool = get_pool(processes or multiprocessing.cpu_count())
+    for index, analysis in pool.imap_unordered(analysis_worker, jobs):
+        yield index, analysis
+
+
+def end_game(saved_state):
+    # Called by the referee when the game of saved_state is over, so a
+    # pondering search does not outlive it.
+    saved_state.stop_pondering()
+
+
+def generate_move(board, player, saved_state=None, connect=4):
+    # board can have any size, connect is the number of stones in a row
+    # needed to win (the referee passes it for variants other than 4).
     # HYPERPARAMETERS
     # time = amount of time allowed to run simulations.
     # max_moves = amount of moves ahead allowed in one simulation
+    # tt_size = maximum number of positions in the transposition table
+    # workers = extra processes searching in parallel (0 = single core)
+    # batch = leaves evaluated per vectorized rollout (0 = one at a time,
+    #     256 on the standard board roughly doubles the simulations)
+    # rollout_policy = 'threats' (take wins, block losses) or 'uniform'
+    # symmetry = share the statistics of mirror-image positions
+    # solver_threshold = empty cells below which the game is solved exactly
+    # solver_time = time the solver gets before falling back to MCTS
+    # solver_endgame_time = the same below solver_threshold, the rest of
+    #     'time' is left to MCTS in case the solver runs out of time
+    # use_book = look positions up in the opening book before searching
+    # verbose = print the search statistics of every move
+    # adaptive_time = let a TimeManager end easy searches before 'time'
+    # ponder = keep searching on a background thread during the opponent's turn
+    # cache_path = path of a persistent stats_cache file shared across
+    #     games, None to start every game from an empty tree
     time = 0.9
     max_moves = 200
+    tt_size = 200000
+    workers = 0
+    batch = 0
+    rollout_policy = 'threats'
+    symmetry = True
+    solver_threshold = 16
+    solver_time = 0.1
+    solver_endgame_time = 0.6
+    use_book = True
+    verbose = False
+    adaptive_time = True
+    ponder = False
+    cache_path = None
+
+    # Convert the referee's board once, the search only sees bitboards.
+    position = bb.from_board(board, player, connect)
+    # the book and the cache hold positions of the standard board only
+    standard = type(position) is bb.Position
+
+    # The saved state is the search tree of our previous move,
+    # re-rooted on the opponent's reply to reuse the earlier simulations.
+    if saved_state is None:
+        AI = MonteCarlo(position, time=time, max_moves=max_moves,
+                        tt_size=tt_size, workers=workers, batch=batch,
+                        rollout_policy=rollout_policy, symmetry=symmetry,
+                        reporter=print_stats if verbose else None,
+                        time_manager=TimeManager() if adaptive_time else None)
+    else:
+        AI = saved_state
+        # stop pondering before re-rooting, the tree keeps what it found
+        AI.stop_pondering()
+        AI.update(position)
 
+    book = opening_book.load() if use_book and standard else None
+    book_move = book.lookup(position) if book is not None else None
+    AI.last_search = None
 
     # if board is empty (all 0), return center column
-    if np.all(board == 0):
-        AI = MonteCarlo(board, time=time, max_moves=max_moves)
-        AI.update(board)
-        board[5, 3] = player
-        AI.update(board)
-        return 3, (AI.board_history, AI.plays, AI.wins)
-
-    # After the first move, start running the MonteCarlo class
-    board_history, plays, wins = list(), dict(), dict()
-    if saved_state:
-        board_history, plays, wins = saved_state
-    AI = MonteCarlo(board, time=time, max_moves=max_moves,
-                    board_history=board_history, wins=wins, plays=plays)
-    AI.update(board)
-    move = AI.get_play()
-    AI.update(next_state(AI.board_history, move))
-    return move, (AI.board_history, AI.plays, AI.wins)
+    if position.moves == 0:
+        move = position.COLS // 2
+    elif book_move is not None and position.can_play(book_move):
+        move = book_move
+    else:
+        # Give the exact solver most of the budget in the endgame and a
+        # short slice before that. Only proven results are played, an
+        # unfinished depth-limited search scores every move 0 and would
+        # just pick the centre, so MCTS searches with the time left.
+        begin = monotonic()
+        endgame = position.CELLS - position.moves < solver_threshold
+        move, score, proven = AI.solver.solve(
+            position, solver_endgame_time if endgame else solver_time)
+        if not proven:
+            cache = stats_cache.load(cache_path) if cache_path and standard else None
+            if cache is not None:
+                AI.seed_from(cache)
+            move, stats = AI.get_play(time - (monotonic() - begin))
+            AI.last_search = stats
+            if cache is not None:
+                AI.export_to(cache)
+    AI.advance(move)
+    if ponder:
+        AI.start_pondering()
+    return move, AI
@@ -0,0 +1,154 @@
+'''
+Opening book: best moves for early positions, computed offline by the engine.
+
+File format: an 8 byte magic header followed by a sorted array of
+little-endian uint64 entries, one per position, each `key << 3 | move` where
+key is bitboard.Position.canonical(), so one entry covers a position and its
+mirror image, with the move in the frame of the key. Books of the first
+format (C4BOOK1) held plain position keys and are rejected. Lookups binary
+search the memory-mapped file, so opening a book costs nothing and no entry
+is loaded into Python objects.
+
+Build a book with:
+    python opening_book.py --depth 6 --time 1.0 opening_book.bin
+'''
+import argparse
+import mmap
+import os
+import struct
+
+import bitboard as bb
+
+MAGIC = b'C4BOOK2\0'
+ENTRY = struct.Struct('<Q')
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opening_book.bin')
+
+
+class OpeningBook(object):
+    '''
+    Read-only view on a book file.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not an opening book'.format(path))
+        self.size = (len(self.mm) - len(MAGIC)) // ENTRY.size
+
+    def __len__(self):
+        return self.size
+
+    def entry(self, index):
+        return ENTRY.unpack_from(self.mm, len(MAGIC) + index * ENTRY.size)[0]
+
+    def lookup(self, position):
+        '''
+        Input: position (bitboard.Position)
+        Output: book move (int) for position, or None if it is not in the book
+        '''
+        key, mirrored = position.canonical()
+        move = self.find(key)
+        if move is not None and mirrored:
+            move = position.COLS - 1 - move
+        return move
+
+    def find(self, key):
+        '''
+        Output: move stored for key, or None
+        '''
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_key = self.entry(mid) >> 3
+            if entry_key < key:
+                lo = mid + 1
+            elif entry_key > key:
+                hi = mid
+            else:
+                return self.entry(mid) & 7
+        return None
+
+    def close(self):
+        self.mm.close()
+
+
+_books = dict()
+
+
+def load(path=DEFAULT_PATH):
+    '''
+    Output: the OpeningBook at path, opened once per process,
+        or None if there is no book file.
+    '''
+    if path not in _books:
+        _books[path] = OpeningBook(path) if os.path.exists(path) else None
+    return _books[path]
+
+
+def write_book(path, moves):
+    '''
+    Input: path (str), moves (dict) mapping canonical position keys to book moves
+    '''
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for key in sorted(moves):
+            f.write(ENTRY.pack(key << 3 | moves[key]))
+
+
+def build_book(depth, time, verbose=True):
+    '''
+    Input: depth (int) number of plies covered by the book,
+        time (float) seconds of engine search per position
+    Method: walks the game tree from the empty board for both colours. On the
+        book side's turn the engine picks the move and only that move is
+        followed, on the other side's turn every reply is followed.
+    Output: dict mapping canonical position keys to book moves
+    '''
+    # imported here so reading a book does not pull in the engine
+    from main_bot import MonteCarlo
+
+    moves = dict()
+    for book_moves_first in (True, False):
+        frontier = [bb.Position(player=1)]
+        for ply in range(depth):
+            book_turn = (ply % 2 == 0) == book_moves_first
+            next_frontier = dict()
+            for position in frontier:
+                if book_turn:
+                    key, mirrored = position.canonical()
+                    last = position.COLS - 1
+                    if key not in moves:
+                        move, score, proven = MonteCarlo(position).solver.solve(position, time)
+                        if not proven:
+                            AI = MonteCarlo(position, time=time)
+                            move, stats = AI.get_play()
+                        moves[key] = last - move if mirrored else move
+                        if verbose:
+                            print('ply {} | {} positions | {}'.format(ply, len(moves), move))
+                    choices = [last - moves[key] if mirrored else moves[key]]
+                else:
+                    choices = position.legal_moves()
+                for move in choices:
+                    if position.is_winning_move(move):
+                        continue
+                    child = bb.next_state(position, move)
+                    # one of every pair of mirror images is enough
+                    next_frontier[child.canonical()[0]] = child
+            frontier = list(next_frontier.values())
+    return moves
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build an opening book.')
+    parser.add_argument('path', nargs='?', default=DEFAULT_PATH)
+    parser.add_argument('--depth', type=int, default=6, help='plies covered by the book')
+    parser.add_argument('--time', type=float, default=1.0, help='search seconds per position')
+    args = parser.parse_args()
+    moves = build_book(args.depth, args.time)
+    write_book(args.path, moves)
+    print('Wrote {} positions to {}'.format(len(moves), args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''
+Packed storage for many boards in one file.
+
+Every cell takes 2 bits (0 empty, 1 and 2 the players), so a 6x7 board fits
+in 11 bytes instead of the 336 bytes of a float64 array. File format: a 16
+byte header (magic, rows, cols) followed by the packed boards, one after the
+other. Packing and unpacking are vectorized over all boards of a file.
+
+Convert the sample boards with:
+    python packed_boards.py sample_boards/boards.c4b sample_boards/dump*.npy
+'''
+import argparse
+import struct
+
+import numpy as np
+
+import bitboard as bb
+
+MAGIC = b'C4PACK1\0'
+HEADER = struct.Struct('<8sHH4x')
+
+
+def board_bytes(rows, cols):
+    return (2 * rows * cols + 7) // 8
+
+
+def pack(boards):
+    '''
+    Input: boards (np.array) of shape (N, rows, cols) with values 0, 1, 2
+    Output: np.array of uint8, shape (N, board_bytes(rows, cols))
+    '''
+    boards = np.asarray(boards)
+    if boards.ndim == 2:
+        boards = boards[None]
+    cells = boards.reshape(len(boards), -1).astype(np.uint8)
+    if cells.size and cells.max() > 2:
+        raise ValueError('boards may only contain 0, 1 and 2')
+    bits = np.stack([cells >> 1, cells & 1], axis=-1).reshape(len(boards), -1)
+    return np.packbits(bits, axis=1)
+
+
+def unpack(packed, rows=bb.ROWS, cols=bb.COLS, dtype=np.float64):
+    '''
+    Input: packed (np.array) of uint8 as returned by pack
+    Output: np.array of shape (N, rows, cols), float64 like the dumps by default
+    '''
+    packed = np.asarray(packed, dtype=np.uint8)
+    bits = np.unpackbits(packed, axis=1)[:, :2 * rows * cols].reshape(len(packed), -1, 2)
+    cells = bits[:, :, 0] << 1 | bits[:, :, 1]
+    return cells.reshape(len(packed), rows, cols).astype(dtype)
+
+
+def to_bitboards(boards):
+    '''
+    Input: boards (np.array) of shape (N, rows, cols), at most 64 bits
+        of bitboard (cols * (rows + 1) <= 64)
+    Output: (stones of player 1, stones of player 2), two uint64 arrays in
+        the bitboard layout, see bitboard.Position.from_array
+    '''
+    boards = np.asarray(boards)
+    nb_rows, nb_cols = boards.shape[-2:]
+    if nb_cols * (nb_rows + 1) > 64:
+        raise ValueError('{}x{} boards do not fit in 64 bits'.format(nb_rows, nb_cols))
+    rows = np.arange(nb_rows)[:, None]
+    cols = np.arange(nb_cols)[None, :]
+    # top row of the array is the top of the board, bit 0 the bottom cell
+    bits = (np.uint64(1) << (cols * (nb_rows + 1) + nb_rows - 1 - rows).astype(np.uint64))
+    stones = [np.where(boards == player, bits, np.uint64(0)).reshape(len(boards), -1)
+              .sum(axis=1, dtype=np.uint64) for player in (1, 2)]
+    return stones[0], stones[1]
+
+
+def save(path, boards):
+    '''
+    Input: path (str), boards (np.array) of shape (N, rows, cols)
+    '''
+    boards = np.asarray(boards)
+    rows, cols = boards.shape[-2:]
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, rows, cols))
+        f.write(pack(boards).tobytes())
+
+
+def load(path, dtype=np.float64):
+    '''
+    Input: path (str) of a packed file
+    Output: np.array of shape (N, rows, cols)
+    '''
+    return unpack(load_packed(path), *shape(path), dtype=dtype)
+
+
+def shape(path):
+    '''
+    Output: (rows, cols) of the boards stored at path
+    '''
+    with open(path, 'rb') as f:
+        magic, rows, cols = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError('{} is not a packed board file'.format(path))
+    return rows, cols
+
+
+def load_packed(path):
+    '''
+    Output: memory-mapped np.array of uint8, one row of packed bytes per board
+    '''
+    rows, cols = shape(path)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER.size).reshape(
+        -1, board_bytes(rows, cols))
+
+
+def convert(path, sources):
+    '''
+    Input: path (str) of the packed file to write, sources (list) of .npy
+        or text dumps, one board per file
+    Method: checks the round trip before returning
+    Output: number of boards written
+    '''
+    boards = np.array([np.load(source) if source.endswith('.npy') else np.loadtxt(source)
+                       for source in sources])
+    save(path, boards)
+    if not np.array_equal(load(path, dtype=boards.dtype), boards):
+        raise ValueError('round trip through {} changed the boards'.format(path))
+    return len(boards)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack board dumps into one file.')
+    parser.add_argument('path')
+    parser.add_argument('sources', nargs='+', help='.npy or text dumps')
+    args = parser.parse_args()
+    count = convert(args.path, args.sources)
+    print('Packed {} boards into {}'.format(count, args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,7 @@
-import numpy as np
+from board_features import legal_moves
 
 
-def legal_moves(board):
-    return np.arange(board.shape[1])[np.sum(board == 0, axis=0) > 0]
-
-
-def generate_move(board, player, saved_state):
+def generate_move(board, player, saved_state, connect=4):
     """Contains all code required to generate a move,
     given a current game state (board & player)
 
@@ -14,10 +10,11 @@ def generate_move(board, player, saved_state):
         board (2D np.array):    game board (element is 0, 1 or 2)
         player (int):           your player number (token to place: 1 or 2)
         saved_state (object):   returned value from previous call
+        connect (int):          tokens in a row needed to win
 
     Returns:
 
-        action (int):                   number in [0, 6]
+        action (int):                   number in [0, board.shape[1] - 1]
         saved_state (optional, object): will be returned to you the
                                         next time your function is called
 
@@ -0,0 +1,220 @@
+'''
+Batched random playouts on vectors of bitboards.
+
+Plays K games out to the end at once: every step draws a random legal column
+for all unfinished games, applies it with the same bit tricks as
+bitboard.Position.play and checks for four in a row with shifts, all as
+NumPy operations over the whole batch. With the 'threats' policy the winning
+cells of both players (bitboard.winning_cells) are computed once for the
+batch and then updated every ply through the windows of the cell played,
+like bitboard.ThreatTable, so games take immediate wins and block immediate
+losses.
+
+Bitboards are stored as int64 (uint64 for exactly 64 bits, e.g. 7x8), wider
+boards (from 8x9 on) as arrays of Python integers, which NumPy handles with
+the same operators.
+'''
+import numpy as np
+
+import bitboard as bb
+
+_rng = np.random.default_rng()
+
+
+def seed(value=None):
+    '''Reseeds the generator used for the random moves.'''
+    global _rng
+    _rng = np.random.default_rng(value)
+
+
+class Tables(object):
+    '''
+    The masks of one bitboard.Position class as NumPy arrays.
+    '''
+
+    def __init__(self, geometry):
+        bits = geometry.COLS * geometry.H1
+        self.dtype = np.int64 if bits < 64 else np.uint64 if bits == 64 else object
+        self.rows = geometry.ROWS
+        self.cols = geometry.COLS
+        self.connect = geometry.CONNECT
+        self.cells = geometry.CELLS
+        self.BOTTOM = np.array(geometry.BOTTOM, dtype=self.dtype)
+        self.TOP = np.array(geometry.TOP, dtype=self.dtype)
+        self.COLUMN = np.array(geometry.COLUMN, dtype=self.dtype)
+        self.BOTTOM_MASK = np.array(geometry.BOTTOM_MASK, dtype=self.dtype)
+        self.BOARD_MASK = np.array(geometry.BOARD_MASK, dtype=self.dtype)
+        # WINDOWS[col * H1 + row] holds the windows through that cell,
+        # padded with empty windows
+        self.h1 = geometry.H1
+        width = max(len(windows) for windows in geometry.CELL_WINDOWS.values())
+        self.WINDOWS = np.zeros((self.cols * self.h1, width), dtype=self.dtype)
+        for bit, windows in geometry.CELL_WINDOWS.items():
+            self.WINDOWS[bit.bit_length() - 1, :len(windows)] = windows
+
+    def array(self, values):
+        return np.array(values, dtype=self.dtype)
+
+
+_tables = dict()
+
+
+def tables(geometry=bb.Position):
+    '''
+    Output: Tables for the bitboard.Position class geometry, built once
+    '''
+    if geometry not in _tables:
+        _tables[geometry] = Tables(geometry)
+    return _tables[geometry]
+
+
+def alignment(stones, geometry=bb.Position):
+    '''
+    Input: stones (np.array) one bitmask per game
+    Output: np.array of bools, True where the stones contain a winning line
+    '''
+    rows, connect = geometry.ROWS, geometry.CONNECT
+    won = np.zeros(len(stones), dtype=bool)
+    for shift in (rows + 1, rows, rows + 2, 1):
+        # see bitboard.alignment
+        m, length = stones, 1
+        while 2 * length <= connect:
+            m = m & (m >> (length * shift))
+            length *= 2
+        if length < connect:
+            m = m & (m >> ((connect - length) * shift))
+        won |= m != 0
+    return won
+
+
+def winning_cells(stones, mask, geometry=bb.Position):
+    '''
+    Vectorized bitboard.winning_cells.
+    Input: stones, mask (np.array) per game
+    Output: np.array, the empty cells that complete a line
+    '''
+    t = tables(geometry)
+    stones, mask = t.array(stones), t.array(mask)
+    rows, connect = t.rows, t.connect
+    cells = stones << 1
+    for i in range(2, connect):
+        cells &= stones << i
+    for shift in (rows + 1, rows, rows + 2):
+        for gap in range(connect):
+            line = np.full_like(stones, t.BOARD_MASK)
+            for i in range(connect):
+                if i < gap:
+                    line &= stones << (gap - i) * shift
+                elif i > gap:
+                    line &= stones >> (i - gap) * shift
+            cells |= line
+    return cells & (t.BOARD_MASK ^ mask)
+
+
+def heights(mask, geometry=bb.Position):
+    '''
+    Input: mask (np.array) all stones, per game
+    Output: np.array (games, columns) with the number of stones per column
+    '''
+    t = tables(geometry)
+    mask = t.array(mask)
+    counts = np.zeros((len(mask), t.cols), dtype=np.int64)
+    for col in range(t.cols):
+        for row in range(t.rows):
+            counts[:, col] += ((mask >> (col * t.h1 + row)) & 1) != 0
+    return counts
+
+
+def play_threats(mine, theirs, current, mask, bit, cell, geometry=bb.Position):
+    '''
+    Vectorized bitboard.ThreatTable.play for moves that do not win.
+    Input: mine, theirs (np.array) winning cells of the player to move and
+        of the other player, current, mask (np.array) stones before the
+        move, bit (np.array) the cell played, cell (np.array) its index
+        col * H1 + row
+    Output: (mine, theirs) after the move, from the point of view of the
+        next player to move
+    '''
+    t = tables(geometry)
+    stones = current | bit
+    mask = mask | bit
+    rest = t.WINDOWS[cell] & ~stones[:, None]
+    # exactly one cell of the window left, and it is empty
+    single = ((rest & (rest - 1)) == 0) & ((rest & mask[:, None]) == 0)
+    new = np.bitwise_or.reduce(np.where(single, rest, np.zeros_like(rest)), axis=1)
+    return theirs & ~bit, (mine & ~bit) | new
+
+
+def batch_rollout(current, mask, moves, player, policy='uniform', geometry=bb.Position):
+    '''
+    Input:
+        current (sequence of int) stones of the player to move, per game
+        mask (sequence of int) all stones, per game
+        moves (sequence of int) stones played, per game
+        player (sequence of int) number of the player to move, per game
+        policy (str) 'uniform' or 'threats', see MonteCarlo.rollout_policy
+        geometry (class) bitboard.Position class of the board
+    Assumes: none of the games is finished yet
+    Method: random playouts, all games advanced one ply per step
+    Output: np.array with the result of every game
+        (1 or 2 for the winner, -1 for a draw)
+    '''
+    t = tables(geometry)
+    BOTTOM, TOP, COLUMN = t.BOTTOM, t.TOP, t.COLUMN
+    current = t.array(current)
+    mask = t.array(mask)
+    moves = np.array(moves, dtype=np.int64)
+    player = np.array(player, dtype=np.int8)
+    result = np.zeros(len(mask), dtype=np.int8)
+    active = np.arange(len(mask))
+    threats = policy == 'threats'
+    if threats:
+        mine = winning_cells(current, mask, geometry)
+        theirs = winning_cells(current ^ mask, mask, geometry)
+        height = heights(mask, geometry)
+
+    while len(active):
+        # random legal column per game: illegal columns never win the argmax
+        legal = (mask[:, None] & TOP[None, :]) == 0
+        scores = _rng.random((len(active), t.cols))
+        scores[~legal] = -1.0
+        if threats:
+            # a playable winning cell of either side scores above any random
+            # column, our own wins above the opponent's (blocks)
+            playable = (mask + t.BOTTOM_MASK) & t.BOARD_MASK
+            wins = mine & playable
+            blocks = theirs & playable
+            scores += 2.0 * ((wins[:, None] & COLUMN[None, :]) != 0)
+            scores += 1.0 * ((blocks[:, None] & COLUMN[None, :]) != 0)
+        col = scores.argmax(axis=1)
+
+        bit = (mask + BOTTOM[col]) & COLUMN[col]
+        if threats:
+            # the threat masks are exact, only a threat cell wins
+            won = (mine & bit) != 0
+            games = np.arange(len(col))
+            cell = col * t.h1 + height[games, col]
+            height[games, col] += 1
+            mine, theirs = play_threats(mine, theirs, current, mask, bit, cell, geometry)
+        else:
+            won = alignment(current | bit, geometry)
+        current ^= mask
+        mask |= bit
+        moves += 1
+        drawn = ~won & (moves == t.cells)
+
+        player = 3 - player
+
+        # most plies end no game, the batch is only compacted when one does
+        done = won | drawn
+        if not done.any():
+            continue
+        result[active[won]] = 3 - player[won]
+        result[active[drawn]] = -1
+        keep = ~done
+        active, current, mask, moves, player = (
+            active[keep], current[keep], mask[keep], moves[keep], player[keep])
+        if threats:
+            mine, theirs, height = mine[keep], theirs[keep], height[keep]
+
+    return result
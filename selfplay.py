@@ -0,0 +1,230 @@
+'''
+Self-play data generation for main_bot.MonteCarlo.
+
+Every position of every self-play game becomes one fixed-size RECORD: the
+bitboard position, the side to move, the root (plays, wins) of the search per
+column, the move played and the final result. Records are appended to binary
+shards of at most `shard_size` records each; a worker only buffers the game it
+is playing, so memory stays bounded however many games are generated.
+ShardReader memory-maps the shards for zero-copy random access.
+
+    python selfplay.py selfplay_data --games 1000 --processes 4 --time 0.2
+'''
+import argparse
+import bisect
+import glob
+import multiprocessing
+import os
+import random
+
+import numpy as np
+
+import bitboard as bb
+import rollout
+
+RECORD = np.dtype([
+    ('current', '<u8'),             # stones of the player to move
+    ('mask', '<u8'),                # all stones
+    ('game', '<u4'),                # game number within the worker
+    ('player', 'u1'),               # player to move (1 or 2)
+    ('moves', 'u1'),                # stones on the board
+    ('move', 'u1'),                 # column that was played
+    ('result', 'i1'),               # 1 win, 0 draw, -1 loss for the player to move
+    ('plays', '<u4', (bb.COLS,)),   # root simulations per column
+    ('wins', '<u4', (bb.COLS,)),    # root wins per column
+])
+SUFFIX = '.c4s'
+
+
+class ShardWriter(object):
+    '''
+    Appends records to the shards `<prefix>-00000.c4s`, `<prefix>-00001.c4s`,
+    ... in directory, starting a new shard every shard_size records.
+    '''
+
+    def __init__(self, directory, prefix, shard_size=65536):
+        self.directory = directory
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shard = 0
+        self.count = 0
+        self.file = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, records):
+        '''
+        Input: records (np.array of RECORD)
+        '''
+        while len(records):
+            if self.file is None or self.count == self.shard_size:
+                self._next_shard()
+            room = self.shard_size - self.count
+            self.file.write(records[:room].tobytes())
+            self.count += len(records[:room])
+            records = records[room:]
+        self.file.flush()
+
+    def _next_shard(self):
+        if self.file is not None:
+            self.file.close()
+            self.shard += 1
+        path = os.path.join(self.directory, '{}-{:05d}{}'.format(
+            self.prefix, self.shard, SUFFIX))
+        self.file = open(path, 'ab')
+        self.count = os.path.getsize(path) // RECORD.itemsize
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ShardReader(object):
+    '''
+    Read-only, memory-mapped view on all shards in a directory. Indexing
+    returns records straight from the mapped files.
+    '''
+
+    def __init__(self, directory):
+        self.paths = sorted(glob.glob(os.path.join(directory, '*' + SUFFIX)))
+        # a record that is still being written is ignored
+        sizes = [os.path.getsize(path) // RECORD.itemsize for path in self.paths]
+        self.paths = [path for path, size in zip(self.paths, sizes) if size]
+        self.sizes = [size for size in sizes if size]
+        self.offsets = list(np.cumsum([0] + self.sizes))
+        self._maps = dict()
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def shard(self, index):
+        '''
+        Output: np.memmap of RECORD for the shard at index
+        '''
+        if index not in self._maps:
+            self._maps[index] = np.memmap(self.paths[index], dtype=RECORD, mode='r',
+                                          shape=(self.sizes[index],))
+        return self._maps[index]
+
+    def shards(self):
+        for index in range(len(self.paths)):
+            yield self.shard(index)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        shard = bisect.bisect_right(self.offsets, index) - 1
+        return self.shard(shard)[index - self.offsets[shard]]
+
+
+def record_position(record):
+    '''
+    Input: record (RECORD)
+    Output: the bitboard.Position stored in record
+    '''
+    return bb.Position(int(record['current']), int(record['mask']),
+                       int(record['moves']), int(record['player']))
+
+
+def play_game(time, random_plies=2, game=0):
+    '''
+    Input: time (float) search seconds per move, random_plies (int) opening
+        moves played uniformly at random for variety, game (int) number
+    Output: np.array of RECORD, one per position of a self-play game
+    '''
+    from main_bot import MonteCarlo
+
+    position = bb.Position(player=1)
+    # the tree keeps its own copy of the root, advance() moves it along
+    AI = MonteCarlo(position.copy(), time=time)
+    records = np.zeros(bb.ROWS * bb.COLS, dtype=RECORD)
+    winner = 0
+    while not winner:
+        record = records[position.moves]
+        record['current'], record['mask'] = position.current, position.mask
+        record['game'], record['player'], record['moves'] = game, position.player, position.moves
+        if position.moves < random_plies:
+            move = random.choice(position.legal_moves())
+        else:
+            move, stats = AI.get_play()
+            for column, (plays, wins) in stats.root.items():
+                record['plays'][column] = plays
+                record['wins'][column] = wins
+        record['move'] = move
+
+        if position.is_winning_move(move):
+            winner = position.player
+        position.play(move)
+        AI.advance(move)
+        if not winner and position.moves == bb.ROWS * bb.COLS:
+            winner = -1
+
+    records = records[:position.moves]
+    if winner > 0:
+        records['result'] = np.where(records['player'] == winner, 1, -1)
+    return records
+
+
+def generate_worker(job):
+    '''
+    Input: job (tuple) of (directory, worker id, number of games, seconds per
+        move, shard size, seed)
+    Output: (worker id, number of records written)
+    '''
+    directory, worker, nb_games, time, shard_size, seed = job
+    random.seed(seed)
+    rollout.seed(seed)
+    writer = ShardWriter(directory, 'selfplay-{}-w{:03d}'.format(seed, worker), shard_size)
+    written = 0
+    try:
+        for game in range(nb_games):
+            records = play_game(time, game=game)
+            writer.write(records)
+            written += len(records)
+    finally:
+        writer.close()
+    return worker, written
+
+
+def generate(directory, nb_games, processes=None, time=0.2, shard_size=65536, seed=0):
+    '''
+    Input: directory (str) for the shards, nb_games (int) in total,
+        processes (int) pool size (None = one per CPU), time (float) search
+        seconds per move, shard_size (int) records per shard, seed (int)
+    Method: splits the games over the pool, every worker writes its own shards
+    Output: number of records written
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    rng = random.Random(seed)
+    jobs = [(directory, worker, nb_games // processes + (worker < nb_games % processes),
+             time, shard_size, rng.getrandbits(32)) for worker in range(processes)]
+    pool = multiprocessing.Pool(processes)
+    total = 0
+    try:
+        for worker, written in pool.imap_unordered(generate_worker, jobs):
+            total += written
+    finally:
+        pool.close()
+        pool.join()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate self-play data.')
+    parser.add_argument('directory')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--time', type=float, default=0.2, help='search seconds per move')
+    parser.add_argument('--shard-size', type=int, default=65536, help='records per shard')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    total = generate(args.directory, args.games, args.processes, args.time,
+                     args.shard_size, args.seed)
+    print('Wrote {} positions to {}'.format(total, args.directory))
+
+
+if __name__ == '__main__':
+    main()
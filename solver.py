@@ -0,0 +1,165 @@
+'''
+Exact negamax alpha-beta solver for bitboard positions.
+
+Scores follow the usual Connect-4 solver convention, always from the point of
+view of the player to move:
+    > 0: win, the sooner the win the higher the score
+    0:   draw (or unknown, see Solver.solve)
+    < 0: loss, the later the loss the higher the score
+'''
+import time
+
+import bitboard as bb
+from transposition import TranspositionTable
+
+# the board geometry comes from the Position class, see bitboard.board_class;
+# moves are searched center first in Position.ORDER
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+class SolverTimeout(Exception):
+    pass
+
+
+def win_score(position):
+    # score for the player to move winning with their next stone
+    return (position.CELLS + 1 - position.moves) // 2
+
+
+class Solver(object):
+    '''
+    Iterative deepening negamax with alpha-beta pruning and a transposition
+    table of its own. Keep one instance per game to reuse the table.
+    Mirror images share their entry, keyed by Position.canonical() with the
+    best move in that frame.
+    '''
+
+    def __init__(self, tt_size=500000):
+        self.table = TranspositionTable(tt_size)
+        self.nodes = 0
+        self.deadline = None
+
+    def solve(self, position, time_limit=None):
+        '''
+        Input: position (bitboard.Position), time_limit (float) seconds or None
+        Method: deepens the search one ply at a time until the result is
+            proven or the time is up. A non-zero score is proven at any depth
+            since unexplored leaves only ever score 0; a zero score is only
+            proven once the search reaches the end of the game.
+        Output: (move, score, proven) for the deepest completed iteration,
+            move is None if no iteration finished in time
+        '''
+        self.nodes = 0
+        self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+        legal = position.legal_moves()
+        for col in legal:
+            if position.is_winning_move(col):
+                return col, win_score(position), True
+
+        result = (None, 0, False)
+        remaining = position.CELLS - position.moves
+        for depth in range(1, remaining + 1):
+            try:
+                move, score = self.search_root(position, depth)
+            except SolverTimeout:
+                break
+            result = (move, score, score != 0 or depth == remaining)
+            if result[2]:
+                break
+        return result
+
+    def search_root(self, position, depth):
+        '''
+        Output: (best move, score) of a full-window search to depth plies
+        '''
+        alpha, beta = -position.CELLS, position.CELLS
+        best_move = None
+        for col in self.ordered_moves(position):
+            child = bb.next_state(position, col)
+            score = -self.negamax(child, -beta, -alpha, depth - 1)
+            if best_move is None or score > alpha:
+                alpha, best_move = score, col
+        return best_move, alpha
+
+    def ordered_moves(self, position):
+        # center first, with the best move found earlier (if any) in front
+        moves = [col for col in position.ORDER if position.can_play(col)]
+        key = position.key()
+        other = bb.mirror(key, table=position.MIRROR)
+        last = position.COLS - 1
+        if other == key:
+            # mirrored moves of a symmetric position have the same score
+            moves = [col for col in moves if 2 * col <= last]
+        entry = self.table.get(min(key, other))
+        if entry is not None and entry[3] is not None:
+            best = last - entry[3] if other < key else entry[3]
+            if best in moves:
+                moves.remove(best)
+                moves.insert(0, best)
+        return moves
+
+    def negamax(self, position, alpha, beta, depth):
+        '''
+        Input: position (bitboard.Position) that is not finished,
+            alpha < beta (int) search window, depth (int) plies left
+        Output: score of position within the window
+        '''
+        self.nodes += 1
+        if self.deadline is not None and not self.nodes & 1023:
+            if time.perf_counter() > self.deadline:
+                raise SolverTimeout()
+
+        cells = position.CELLS
+        if position.moves == cells:
+            return 0
+        for col in position.ORDER:
+            if position.can_play(col) and position.is_winning_move(col):
+                return win_score(position)
+        if depth == 0 or position.moves == cells - 1:
+            return 0
+
+        # the player to move has no winning move (checked above), so the
+        # best possible result is winning with their following stone, two
+        # plies later: that score is an upper bound for beta
+        best_possible = (cells - 1 - position.moves) // 2
+        if beta > best_possible:
+            beta = best_possible
+            if alpha >= beta:
+                return beta
+
+        key, mirrored = position.canonical()
+        entry = self.table.get(key)
+        if entry is not None and entry[0] >= depth:
+            entry_depth, flag, value, move = entry
+            if flag == EXACT:
+                return value
+            if flag == LOWER and value > alpha:
+                alpha = value
+            elif flag == UPPER and value < beta:
+                beta = value
+            if alpha >= beta:
+                return value
+
+        original_alpha = alpha
+        best_value, best_move = -cells, None
+        for col in self.ordered_moves(position):
+            child = bb.next_state(position, col)
+            score = -self.negamax(child, -beta, -alpha, depth - 1)
+            if score > best_value:
+                best_value, best_move = score, col
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+
+        if best_value <= original_alpha:
+            flag = UPPER
+        elif best_value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        if mirrored:
+            best_move = position.COLS - 1 - best_move
+        self.table.store(key, (depth, flag, best_value, best_move))
+        return best_value
@@ -0,0 +1,192 @@
+'''
+Persistent MCTS statistics shared across games and processes.
+
+An open-addressing hash table in a memory-mapped file maps position keys
+(bitboard.Position.key()) to the accumulated (plays, wins) of the tree node for
+that position, wins counted for the player who moved into it like Node.wins.
+The file has a fixed number of slots, so its size is bounded; when the probe
+window of a key is full the least played slot is replaced.
+
+Writers buffer their updates in memory and add them to the file in flush(),
+under an exclusive lock on the file, optionally from a background thread.
+Readers take a shared lock per lookup, so any number of processes can read
+while one of them flushes.
+'''
+import atexit
+import fcntl
+import os
+import struct
+import threading
+
+import numpy as np
+
+MAGIC = b'C4STAT1\0'
+HEADER = struct.Struct('<8sQ')
+SLOT = np.dtype([('key', '<u8'), ('plays', '<u4'), ('wins', '<u4')])
+PROBES = 8
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stats_cache.bin')
+_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def create(path, capacity):
+    '''
+    Input: path (str), capacity (int) number of slots, rounded up to a power of two
+    Method: writes an empty table to a temporary file and moves it into place,
+        so other processes never see a half-written table
+    '''
+    capacity = 1 << max(0, capacity - 1).bit_length()
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, capacity))
+        f.truncate(HEADER.size + capacity * SLOT.itemsize)
+    os.replace(tmp, path)
+
+
+class StatsCache(object):
+    '''
+    path:           file of the table, created if it does not exist
+    capacity:       number of slots of a new table
+    readonly:       open for lookups only
+    flush_interval: seconds between background flushes, None to only flush
+                    on flush() and close()
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, capacity=1 << 20, readonly=False, flush_interval=10.0):
+        if not os.path.exists(path):
+            if readonly:
+                raise IOError('no statistics cache at {}'.format(path))
+            create(path, capacity)
+        self.path = path
+        self.readonly = readonly
+        self.file = open(path, 'rb' if readonly else 'r+b')
+        magic, self.capacity = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('{} is not a statistics cache'.format(path))
+        self.bits = self.capacity.bit_length() - 1
+        self.slots = np.memmap(path, dtype=SLOT, mode='r' if readonly else 'r+',
+                               offset=HEADER.size, shape=(self.capacity,))
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.closed = threading.Event()
+        if not readonly and flush_interval:
+            self.flusher = threading.Thread(target=self._flush_loop, args=(flush_interval,))
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def _probe(self, key):
+        # the slots that may hold key, in probing order
+        start = ((key + 1) * _MULTIPLIER & 0xFFFFFFFFFFFFFFFF) >> (64 - self.bits) if self.bits else 0
+        return [(start + i) & (self.capacity - 1) for i in range(min(PROBES, self.capacity))]
+
+    def lookup(self, key):
+        '''
+        Input: key (int) position key
+        Output: (plays, wins) stored for key, including updates of this
+            process that were not flushed yet, or None if key is unknown
+        '''
+        stored = None
+        # keys are stored plus one, so zero marks an empty slot
+        fcntl.flock(self.file, fcntl.LOCK_SH)
+        try:
+            for index in self._probe(key):
+                stored_key = self.slots['key'][index]
+                if stored_key == key + 1:
+                    stored = (int(self.slots['plays'][index]), int(self.slots['wins'][index]))
+                    break
+                if not stored_key:
+                    break
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        with self.lock:
+            delta = self.pending.get(key)
+        if delta is None:
+            return stored
+        if stored is None:
+            return tuple(delta)
+        return stored[0] + delta[0], stored[1] + delta[1]
+
+    def record(self, key, plays, wins):
+        '''
+        Input: key (int) position key, plays and wins (int) new simulations
+            to add to the statistics of the position
+        '''
+        if self.readonly:
+            raise IOError('{} was opened read-only'.format(self.path))
+        with self.lock:
+            delta = self.pending.setdefault(key, [0, 0])
+            delta[0] += plays
+            delta[1] += wins
+
+    def flush(self):
+        '''
+        Method: adds the buffered updates to the file. A key that finds its
+            probe window full replaces the least played slot, if it has
+            more plays itself.
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        if not pending:
+            return
+        slots = self.slots
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            for key, (plays, wins) in pending.items():
+                weakest = None
+                for index in self._probe(key):
+                    stored = slots['key'][index]
+                    if stored == key + 1:
+                        # counters saturate instead of wrapping around
+                        slots['plays'][index] = min(0xFFFFFFFF, int(slots['plays'][index]) + plays)
+                        slots['wins'][index] = min(0xFFFFFFFF, int(slots['wins'][index]) + wins)
+                        break
+                    if not stored:
+                        slots[index] = (key + 1, plays, wins)
+                        break
+                    if weakest is None or slots['plays'][index] < slots['plays'][weakest]:
+                        weakest = index
+                else:
+                    if slots['plays'][weakest] < plays:
+                        slots[weakest] = (key + 1, plays, wins)
+            slots.flush()
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def _flush_loop(self, interval):
+        while not self.closed.wait(interval):
+            self.flush()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.slots['key']))
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        if not self.readonly:
+            self.flush()
+        self.file.close()
+
+
+_caches = dict()
+
+
+def load(path=DEFAULT_PATH, readonly=False):
+    '''
+    Output: the StatsCache at path, opened once per process and flushed
+        when the process exits
+    '''
+    if path not in _caches:
+        _caches[path] = StatsCache(path, readonly=readonly)
+    return _caches[path]
+
+
+def close_all():
+    for cache in _caches.values():
+        cache.close()
+    _caches.clear()
+
+
+atexit.register(close_all)
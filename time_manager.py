@@ -0,0 +1,85 @@
+'''
+Adaptive time management for MonteCarlo searches.
+
+Every search gets a hard limit (the time left for the move) and a soft budget
+derived from the game phase and the number of legal moves. The search may stop
+before the soft budget once the most visited root move can no longer be
+overtaken, and stops at the soft budget only if the best move has been stable
+for a few checks; otherwise it continues up to the hard limit.
+'''
+
+
+class TimeManager(object):
+    '''
+    min_fraction:   smallest share of the hard limit used as soft budget
+    stable_checks:  checks in a row the best move must stay the same before
+                    the search stops at the soft budget
+    '''
+
+    def __init__(self, min_fraction=0.3, stable_checks=4):
+        self.min_fraction = min_fraction
+        self.stable_checks = stable_checks
+        self.soft = 0.0
+        self.best = None
+        self.stable = 0
+        self.changes = 0
+
+    def phase_factor(self, moves, cells=42):
+        '''
+        Input: moves (int) stones on the board, cells (int) on the board
+        Output: share of the time to spend in this phase of the game. The
+            opening is mostly covered by the book and the endgame by the
+            solver, the middle game gets the full budget.
+        '''
+        if moves < 8:
+            return 0.6
+        if moves > cells - 20:
+            return 0.7
+        return 1.0
+
+    def budget(self, position, legal, limit):
+        '''
+        Input: position (bitboard.Position), legal (list) moves,
+            limit (float) hard limit in seconds
+        Method: starts tracking a new search
+        Output: soft budget in seconds
+        '''
+        legal_factor = 0.5 + 0.5 * len(legal) / position.COLS
+        phase = self.phase_factor(position.moves, position.CELLS)
+        fraction = max(self.min_fraction, phase * legal_factor)
+        self.soft = limit * min(1.0, fraction)
+        self.best = None
+        self.stable = 0
+        self.changes = 0
+        return self.soft
+
+    def should_stop(self, root, elapsed, remaining, simulations):
+        '''
+        Input: root (main_bot.Node), elapsed and remaining (float) seconds
+            of the search, simulations (int) run so far
+        Output: True if searching on cannot change the chosen move, or if the
+            soft budget is used up and the best move is stable
+        '''
+        if len(root.children) < 2:
+            return False
+        first, second = 0, 0
+        best = None
+        for move, child in root.children.items():
+            if child.plays > first:
+                first, second, best = child.plays, first, move
+            elif child.plays > second:
+                second = child.plays
+
+        if best == self.best:
+            self.stable += 1
+        else:
+            if self.best is not None:
+                self.changes += 1
+            self.best, self.stable = best, 0
+
+        # even if every remaining simulation went to the runner-up it
+        # would not catch up with the best move
+        rate = simulations / elapsed if elapsed else 0.0
+        if first - second > rate * remaining:
+            return True
+        return elapsed >= self.soft and self.stable >= self.stable_checks
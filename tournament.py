@@ -0,0 +1,173 @@
+'''
+Headless round-robin tournaments between generate_move functions.
+
+Games are played with the ConnectFour referee through
+connectfour_offline.play_game, spread over a process pool with printing
+turned off. Every game gets its own seed, derived from the tournament seed,
+so a tournament between deterministic bots can be replayed exactly.
+
+    python tournament.py main_bot:generate_move random_legal_bot:generate_move \
+        fun_bots.random_bot:generate_move --games 100 --processes 4 --seed 0
+
+With --log every game is appended to a game log, see game_log.
+'''
+import argparse
+import contextlib
+import functools
+import importlib
+import itertools
+import math
+import multiprocessing
+import os
+import random
+
+import numpy as np
+
+from connectfour_offline import play_game
+from game_log import GameLog
+
+
+def bot_spec(bot):
+    '''
+    Input: bot, either a module-level generate_move function or a
+        'module:function' string
+    Output: the 'module:function' string naming it, which is what is sent
+        to the pool processes
+    '''
+    if isinstance(bot, str):
+        return bot
+    return '{}:{}'.format(bot.__module__, bot.__qualname__)
+
+
+def load_bot(spec):
+    '''
+    Input: spec (str) of the form 'module:function'
+    Output: the generate_move function it names
+    '''
+    module, _, function = spec.partition(':')
+    return getattr(importlib.import_module(module), function or 'generate_move')
+
+
+_logs = dict()
+
+
+def play_job(job, variant=(6, 7, 4), log_path=None):
+    '''
+    Input: job (tuple) of (first bot spec, second bot spec, starting player, seed),
+        variant (tuple) of the board rows, cols and connect length,
+        log_path (str) game log shared by all pool processes, or None
+    Method: plays one game in a pool process with all output discarded
+    Output: the job followed by (winning player, points)
+    '''
+    first, second, starting_player, seed = job
+    rows, cols, connect = variant
+    random.seed(seed)
+    np.random.seed(seed)
+    log = None
+    if log_path is not None:
+        if log_path not in _logs:
+            _logs[log_path] = GameLog(log_path)
+        log = _logs[log_path]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        winning_player, points, info = play_game(
+            load_bot(first), load_bot(second), starting_player, verbose=False,
+            rows=rows, cols=cols, connect=connect, log=log)
+    return job + (winning_player, points)
+
+
+def schedule(bots, games_per_pair, seed):
+    '''
+    Output: list of jobs for a round robin in which every pair of bots
+        plays games_per_pair games, alternating the starting player
+    '''
+    rng = random.Random(seed)
+    jobs = []
+    for first, second in itertools.combinations(bots, 2):
+        for game in range(games_per_pair):
+            jobs.append((first, second, game % 2, rng.getrandbits(32)))
+    return jobs
+
+
+def score_interval(wins, draws, losses, z=1.96):
+    '''
+    Input: game counts for one bot, z (float) normal quantile
+    Output: (score, low, high) with score the mean result per game
+        (win 1, draw 0.5, loss 0) and its normal-approximation interval
+    '''
+    n = wins + draws + losses
+    if not n:
+        return 0.0, 0.0, 1.0
+    score = (wins + 0.5 * draws) / n
+    variance = (wins + 0.25 * draws) / n - score ** 2
+    margin = z * math.sqrt(max(variance, 0.0) / n)
+    return score, max(0.0, score - margin), min(1.0, score + margin)
+
+
+def run_tournament(bots, games_per_pair=10, processes=None, seed=0, variant=(6, 7, 4),
+                   log_path=None):
+    '''
+    Input: bots (list) generate_move functions or 'module:function' specs,
+        games_per_pair (int),
+        processes (int) pool size (None = one per CPU), seed (int),
+        variant (tuple) of the board rows, cols and connect length,
+        log_path (str) game log to append every game to, or None
+    Output: dict mapping every bot to its wins, draws, losses, points,
+        games and score interval. A draw is a game that filled the board,
+        the referee still gives a point to the player with the longest chain.
+    '''
+    bots = [bot_spec(bot) for bot in bots]
+    results = dict((bot, {'wins': 0, 'draws': 0, 'losses': 0, 'points': 0})
+                   for bot in bots)
+    jobs = schedule(bots, games_per_pair, seed)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for first, second, starting, game_seed, winner, points in \
+                pool.imap_unordered(functools.partial(play_job, variant=variant,
+                                                      log_path=log_path), jobs):
+            players = (first, second)
+            won, lost = players[winner], players[1 - winner]
+            results[won]['points'] += points
+            if points == 5:
+                results[won]['wins'] += 1
+                results[lost]['losses'] += 1
+            else:
+                results[won]['draws'] += 1
+                results[lost]['draws'] += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    for stats in results.values():
+        stats['games'] = stats['wins'] + stats['draws'] + stats['losses']
+        stats['score'] = score_interval(stats['wins'], stats['draws'], stats['losses'])
+    return results
+
+
+def print_results(results):
+    ranking = sorted(results.items(), key=lambda item: -item[1]['points'])
+    print('{:<40} {:>5} {:>5} {:>5} {:>5} {:>7}  {}'.format(
+        'bot', 'games', 'W', 'D', 'L', 'points', 'score (95% CI)'))
+    for bot, stats in ranking:
+        print('{:<40} {:>5} {:>5} {:>5} {:>5} {:>7}  {:.3f} ({:.3f}-{:.3f})'.format(
+            bot, stats['games'], stats['wins'], stats['draws'], stats['losses'],
+            stats['points'], *stats['score']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Round-robin tournament between bots.')
+    parser.add_argument('bots', nargs='+', help="bots as 'module:function'")
+    parser.add_argument('--games', type=int, default=10, help='games per pair of bots')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rows', type=int, default=6)
+    parser.add_argument('--cols', type=int, default=7)
+    parser.add_argument('--connect', type=int, default=4)
+    parser.add_argument('--log', default=None, help='append every game to this game log')
+    args = parser.parse_args()
+    variant = (args.rows, args.cols, args.connect)
+    print_results(run_tournament(args.bots, args.games, args.processes, args.seed, variant,
+                                 args.log))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+
+
+class TranspositionTable(object):
+    '''
+    Bounded hash table keyed by position keys, e.g. the canonical key of
+    bitboard Position.canonical().
+
+    Holds at most `capacity` entries. When a new entry does not fit, the
+    least recently used one is evicted. Counters for hits, misses and
+    evictions are kept so the capacity can be tuned against a memory budget.
+    '''
+
+    def __init__(self, capacity=200000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_full(self):
+        return len(self.entries) >= self.capacity
+
+    def get(self, key, default=None):
+        '''
+        Input: key (int) of a position
+        Output: the stored value, or default when key is unknown
+        '''
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def store(self, key, value):
+        '''
+        Input: key (int) of a position, value (object) to keep
+        Method: insert or refresh the entry, evict the oldest one if full
+        '''
+        entries = self.entries
+        entries[key] = value
+        entries.move_to_end(key)
+        if len(entries) > self.capacity:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def prune(self, keep):
+        '''
+        Input: keep (function) predicate on stored values
+        Method: drop every entry whose value does not satisfy keep,
+            e.g. positions that can no longer occur in the current game.
+        '''
+        for key in [k for k, value in self.entries.items() if not keep(value)]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        '''
+        Output: dict with the size, capacity, hit/miss/eviction counters
+            and the hit rate of the table.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
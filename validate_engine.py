@@ -0,0 +1,357 @@
+'''
+Cross-checks the fast engine code against the original NumPy implementation.
+
+Run as a script: prints one line per check and exits with a non-zero status
+when any of them finds a disagreement.
+'''
+import glob
+import shutil
+import sys
+import tempfile
+from random import choice, seed
+
+import numpy as np
+
+import bitboard as bb
+import board_features
+import main_bot
+import opening_book
+import packed_boards
+import rollout
+import selfplay
+from solver import Solver
+from connectfour_offline import BatchConnectFour, ConnectFour
+
+
+# board variants (rows, cols, connect) checked besides the standard board
+VARIANTS = [(7, 8, 4), (8, 9, 4), (9, 10, 5)]
+
+
+def load_sample_boards(pattern='sample_boards/dump*.npy'):
+    return [np.load(path) for path in sorted(glob.glob(pattern))]
+
+
+def check_winner_random_games(nb_games=500, geometry=bb.Position):
+    '''
+    Plays random games and compares the incremental last-move check of the
+    bitboard engine with main_bot.find_winner on the full board after every ply.
+    '''
+    errors = 0
+    for _ in range(nb_games):
+        position = geometry(player=1)
+        while True:
+            move = choice(position.legal_moves())
+            player = position.player
+            won = position.is_winning_move(move)
+            position.play(move)
+            if won:
+                incremental = player
+            elif position.moves == position.CELLS:
+                incremental = -1
+            else:
+                incremental = 0
+            full = main_bot.find_winner(position.to_array(), position.CONNECT)
+            if incremental != full or position.winner() != full:
+                errors += 1
+            if full:
+                break
+    return errors
+
+
+def check_winner_sample_boards(boards):
+    '''
+    For every sample board, both players and every legal column, compares
+    is_winning_move with main_bot.find_winner on the resulting board.
+    '''
+    errors = 0
+    for board in boards:
+        for player in (1, 2):
+            position = bb.Position.from_array(board, player)
+            if bb.find_winner(position) != main_bot.find_winner(board):
+                errors += 1
+            if main_bot.find_winner(board):
+                continue  # game already decided, no move can change that
+            for move in position.legal_moves():
+                won = position.is_winning_move(move)
+                child = bb.next_state(position, move).to_array()
+                if won != (main_bot.find_winner(child) == player):
+                    errors += 1
+    return errors
+
+
+def check_threat_table(nb_games=300, geometry=bb.Position):
+    '''
+    Plays random games keeping a bitboard.ThreatTable up to date and compares
+    it after every ply with winning_cells computed from scratch, with its
+    vectorized version in rollout, and its win flag with is_winning_move.
+    '''
+    errors = 0
+    for _ in range(nb_games):
+        position = geometry(player=1)
+        table = bb.ThreatTable(position)
+        while position.moves < position.CELLS:
+            move = choice(position.legal_moves())
+            won = table.play(position, move)
+            if won != position.is_winning_move(move):
+                errors += 1
+            if won:
+                break
+            position.play(move)
+            for player, stones in ((position.player, position.current),
+                                   (3 - position.player, position.current ^ position.mask)):
+                expected = position.winning_cells(stones)
+                vectorized = rollout.winning_cells([stones], [position.mask], geometry)
+                if table.threats[player] != expected or int(vectorized[0]) != expected:
+                    errors += 1
+    return errors
+
+
+def check_batch_threats(nb_games=200, geometry=bb.Position):
+    '''
+    Plays random games as one batch, updating the threat masks of both
+    players with rollout.play_threats, and compares them after every ply
+    with rollout.winning_cells from scratch, and the win flag with
+    rollout.alignment.
+    '''
+    t = rollout.tables(geometry)
+    current = t.array([0] * nb_games)
+    mask = t.array([0] * nb_games)
+    mine = rollout.winning_cells(current, mask, geometry)
+    theirs = rollout.winning_cells(current ^ mask, mask, geometry)
+    height = rollout.heights(mask, geometry)
+    errors = 0
+    for ply in range(geometry.CELLS):
+        col = np.array([choice([c for c in range(geometry.COLS)
+                                if height[game, c] < geometry.ROWS])
+                        for game in range(len(mask))])
+        games = np.arange(len(col))
+        bit = (mask + t.BOTTOM[col]) & t.COLUMN[col]
+        won = (mine & bit) != 0
+        errors += int(np.count_nonzero(won != rollout.alignment(current | bit, geometry)))
+        cell = col * t.h1 + height[games, col]
+        height[games, col] += 1
+        mine, theirs = rollout.play_threats(mine, theirs, current, mask, bit, cell, geometry)
+        current ^= mask
+        mask |= bit
+        keep = ~won
+        current, mask, mine, theirs, height = (
+            current[keep], mask[keep], mine[keep], theirs[keep], height[keep])
+        if not len(mask):
+            break
+        expected_mine = rollout.winning_cells(current, mask, geometry)
+        expected_theirs = rollout.winning_cells(current ^ mask, mask, geometry)
+        errors += int(np.count_nonzero((mine != expected_mine) | (theirs != expected_theirs)))
+    return errors
+
+
+def check_batch_referee(nb_games=300, variant=(6, 7, 4)):
+    '''
+    Plays the same random games on BatchConnectFour and on one ConnectFour
+    per game, comparing boards, done flags and points after every move.
+    '''
+    batch = BatchConnectFour(nb_games, *variant)
+    referees = [ConnectFour(*variant) for _ in range(nb_games)]
+    infos = [referee._get_info() for referee in referees]
+    errors = 0
+    player = 0
+    while not all(info['done'] for info in infos):
+        actions = np.zeros(nb_games, dtype=int)
+        for game, referee in enumerate(referees):
+            if not infos[game]['done']:
+                actions[game] = choice(main_bot.legal_moves(referee.board))
+                referee.board, infos[game] = referee.move(actions[game], player)
+        boards, info = batch.move(actions, player)
+        for game, referee in enumerate(referees):
+            if (not np.array_equal(boards[game], referee.board)
+                    or bool(info['done'][game]) != infos[game]['done']
+                    or info['points'][game].tolist() != infos[game]['points']):
+                errors += 1
+        player = 1 - player
+    return errors
+
+
+def check_packed_boards(boards, path='sample_boards/boards.c4b'):
+    '''
+    Compares the packed sample boards with the np.load and np.loadtxt dumps,
+    and the vectorized bitboard conversion with bitboard.Position.from_array.
+    '''
+    texts = [np.loadtxt(name) for name in sorted(glob.glob('sample_boards/dump*txt'))]
+    packed = packed_boards.load(path)
+    errors = 0
+    if len(packed) != len(boards):
+        return abs(len(packed) - len(boards))
+    for board, text, unpacked in zip(boards, texts, packed):
+        if not (np.array_equal(board, unpacked) and np.array_equal(text, unpacked)):
+            errors += 1
+    ones, twos = packed_boards.to_bitboards(packed)
+    for board, one, two in zip(boards, ones, twos):
+        position = bb.Position.from_array(board, 1)
+        if position.current != int(one) or position.mask != int(one | two):
+            errors += 1
+    return errors
+
+
+def check_mirror(boards, nb_games=100):
+    '''
+    Compares bitboard.mirror with the flipped board on random game positions,
+    and for the sample boards checks that a position and its mirror image
+    share the canonical key and get mirrored moves from the solver (with one
+    table for both) and the opening book.
+    '''
+    errors = 0
+    for _ in range(nb_games):
+        position = bb.Position(player=1)
+        while position.winner() == 0:
+            board = position.to_array()
+            flipped = bb.Position.from_array(board[:, ::-1], position.player)
+            if flipped.key() != bb.mirror(position.key()):
+                errors += 1
+            position.play(choice(position.legal_moves()))
+
+    solver = Solver()
+    book = opening_book.load()
+    last = bb.COLS - 1
+    for board in boards:
+        for player in (1, 2):
+            position = bb.Position.from_array(board, player)
+            flipped = bb.Position.from_array(board[:, ::-1], player)
+            if position.winner() or flipped.winner():
+                continue
+            (key, mirrored), (flipped_key, flipped_mirrored) = position.canonical(), flipped.canonical()
+            if key != flipped_key or (mirrored == flipped_mirrored and position.key() != flipped.key()):
+                errors += 1
+            moves = position.canonical_moves()
+            if moves != flipped.canonical_moves():
+                errors += 1
+            move, score, proven = solver.solve(position, 0.5)
+            flipped_move, flipped_score, flipped_proven = solver.solve(flipped, 0.5)
+            if proven and flipped_proven and score != flipped_score:
+                errors += 1
+            book_move = book.lookup(position) if book is not None else None
+            if (book_move is not None and key != bb.mirror(key)
+                    and book.lookup(flipped) != last - book_move):
+                errors += 1
+    return errors
+
+
+def check_board_features(nb_games=200, variant=(6, 7, 4)):
+    '''
+    Plays random games on the referee, which derives the features of every
+    new board from the previous ones, and compares them after every move with
+    features computed from scratch and with plain loops over the cells.
+    '''
+    errors = 0
+    for _ in range(nb_games):
+        referee = ConnectFour(*variant)
+        info = referee._get_info()
+        player = 0
+        while not info['done']:
+            board = referee.board
+            features = board_features.features(board)
+            fresh = board_features.compute(board.copy())
+            rows, cols = board.shape
+            chains = []
+            for col in range(cols):
+                stones = [int(cell) for cell in board[::-1, col] if cell]
+                length = 0
+                for cell in reversed(stones):
+                    if cell != stones[-1]:
+                        break
+                    length += 1
+                chains.append((col, stones[-1], length) if stones else (col, None, None))
+            heights = [len(board[:, col].nonzero()[0]) for col in range(cols)]
+            if (features.chains() != chains or fresh.chains() != chains
+                    or features.heights.tolist() != heights
+                    or features.open_columns.tolist() != [col for col in range(cols)
+                                                          if heights[col] < rows]):
+                errors += 1
+            move = choice(features.open_columns.tolist())
+            referee.board, info = referee.move(move, player)
+            player = 1 - player
+    return errors
+
+
+def check_selfplay(nb_games=2, time=0.02):
+    '''
+    Generates a few self-play games and replays the recorded moves, comparing
+    every record with the replayed position: the stones, the side to move,
+    root statistics only for legal columns, a legal move and the final result.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        selfplay.generate(directory, nb_games, processes=1, time=time)
+        records = list(selfplay.ShardReader(directory))
+    finally:
+        shutil.rmtree(directory)
+    errors = 0
+    games = []
+    for record in records:
+        if record['moves'] == 0:
+            games.append([])
+        games[-1].append(record)
+    if len(games) != nb_games:
+        errors += abs(len(games) - nb_games)
+    for game in games:
+        position = bb.Position(player=1)
+        winner = 0
+        for record in game:
+            stored = selfplay.record_position(record)
+            legal = position.legal_moves()
+            move = int(record['move'])
+            searched = [column for column in range(bb.COLS) if record['plays'][column]]
+            if (stored.key() != position.key() or stored.player != position.player
+                    or move not in legal or not set(searched) <= set(legal)):
+                errors += 1
+                break
+            if position.is_winning_move(move):
+                winner = position.player
+            position.play(move)
+        if not winner and position.moves < position.CELLS:
+            errors += 1
+        for record in game:
+            expected = 0 if not winner else (1 if record['player'] == winner else -1)
+            if record['result'] != expected:
+                errors += 1
+                break
+    return errors
+
+
+def main():
+    seed(0)
+    boards = load_sample_boards()
+    checks = [
+        ('winner on random games', check_winner_random_games),
+        ('winner on sample boards', lambda: check_winner_sample_boards(boards)),
+        ('threat table against winning cells', check_threat_table),
+        ('batch threats against winning cells', check_batch_threats),
+        ('batch referee against ConnectFour', check_batch_referee),
+        ('packed sample boards', lambda: check_packed_boards(boards)),
+        ('mirror images', lambda: check_mirror(boards)),
+        ('board features', check_board_features),
+        ('self-play records against a replay', check_selfplay),
+    ]
+    for variant in VARIANTS:
+        geometry = bb.board_class(*variant)
+        name = '{}x{} connect {}'.format(*variant)
+        checks += [
+            ('winner on random games ' + name,
+             lambda geometry=geometry: check_winner_random_games(100, geometry)),
+            ('threat table ' + name,
+             lambda geometry=geometry: check_threat_table(50, geometry)),
+            ('batch threats ' + name,
+             lambda geometry=geometry: check_batch_threats(50, geometry)),
+            ('batch referee ' + name,
+             lambda variant=variant: check_batch_referee(50, variant)),
+            ('board features ' + name,
+             lambda variant=variant: check_board_features(50, variant)),
+        ]
+    failed = False
+    for name, check in checks:
+        errors = check()
+        print('{}: {}'.format(name, 'ok' if not errors else '{} mismatches'.format(errors)))
+        failed = failed or errors > 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())